@@ -5,6 +5,20 @@ Cookie Clicker Simulator
 import simpleplot
 import math
 import random
+import time
+import bisect
+
+# History columns are typed arrays where the module is available
+try:
+    from array import array
+except ImportError:
+    array = None
+
+# Tournaments run in a process pool where one is available
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 # Used to increase the timeout, if necessary
 import codeskulptor
@@ -16,6 +30,20 @@ import poc_clicker_provided as provided
 SIM_TIME = 10000000000.0
 #SIM_TIME = 100
 
+# History modes for ClickerState
+HISTORY_OFF = 0        # Record nothing
+HISTORY_FULL = 1       # Record every purchase
+HISTORY_DECIMATED = 2  # Keep an evenly thinned curve of bounded size
+
+def _history_column(typecode):
+    """
+    Return an empty history column: an array of typecode, or a list
+    if the array module is not available
+    """
+    if array == None:
+        return []
+    return array(typecode)
+
 class ClickerState:
     """
     Simple class to keep track of the game state.
@@ -24,20 +52,36 @@ class ClickerState:
     _current_amount = 0.0
     _current_time = 0.0
     _current_cps = 1.0
-    _history = []
     
-    def __init__(self):
+    def __init__(self, history_mode = HISTORY_FULL, history_size = 1000):
+        """
+        history_mode is HISTORY_OFF, HISTORY_FULL or HISTORY_DECIMATED.
+        In decimated mode at most history_size entries are kept: when
+        the history fills up every other entry is dropped and from then
+        on only every other purchase is recorded.
+        """
         self._total_cookies = 0.0
         self._current_amount = 0.0
         self._current_time = 0.0
         self._current_cps = 1.0
-        self._history = [(0.0, None, 0.0, 0.0)]
+        self._history_mode = history_mode
+        self._history_size = max(2, history_size)
+        # History is stored by column, items as ids into _item_names
+        self._item_names = [None]
+        self._item_ids = {None: 0}
+        self._history_times = _history_column("d")
+        self._history_items = _history_column("H")
+        self._history_costs = _history_column("d")
+        self._history_totals = _history_column("d")
+        self._history_count = 0
+        self._history_stride = 1
+        self._record(None, 0.0)
         
     def __str__(self):
         """
         Return human readable state
         """
-        return "\n" + "------------------------" + "\n" + "Total cookies: " + str(self._total_cookies) + "\n" + "Current amount: " + str(self._current_amount) + "\n" + "Current time: " + str(self._current_time) + "\n" + "Current CPS: " + str(self._current_cps) + "\n" + "History: " + str(self._history) + "\n" + "------------------------"
+        return "\n" + "------------------------" + "\n" + "Total cookies: " + str(self._total_cookies) + "\n" + "Current amount: " + str(self._current_amount) + "\n" + "Current time: " + str(self._current_time) + "\n" + "Current CPS: " + str(self._current_cps) + "\n" + "History: " + str(self.get_history()) + "\n" + "------------------------"
         
     def get_cookies(self):
         """
@@ -48,6 +92,14 @@ class ClickerState:
         """
         return self._current_amount
     
+    def get_total_cookies(self):
+        """
+        Return total number of cookies produced so far
+
+        Should return a float
+        """
+        return self._total_cookies
+
     def get_cps(self):
         """
         Get current CPS
@@ -72,8 +124,41 @@ class ClickerState:
         (time, item, cost of item, total cookies)
 
         For example: (0.0, None, 0.0, 0.0)
+
+        Empty when history is off, thinned out when it is decimated
+        """
+        names = self._item_names
+        return [(self._history_times[index], names[self._history_items[index]],
+                 self._history_costs[index], self._history_totals[index])
+                for index in range(len(self._history_times))]
+
+    def _record(self, item_name, cost):
         """
-        return self._history
+        Add a purchase to the history according to the history mode
+        """
+        if self._history_mode == HISTORY_OFF:
+            return
+        count = self._history_count
+        self._history_count += 1
+        if self._history_mode == HISTORY_DECIMATED:
+            if count % self._history_stride != 0:
+                return
+            if len(self._history_times) >= self._history_size:
+                self._history_times = self._history_times[::2]
+                self._history_items = self._history_items[::2]
+                self._history_costs = self._history_costs[::2]
+                self._history_totals = self._history_totals[::2]
+                self._history_stride *= 2
+                if count % self._history_stride != 0:
+                    return
+
+        if item_name not in self._item_ids:
+            self._item_ids[item_name] = len(self._item_names)
+            self._item_names.append(item_name)
+        self._history_times.append(self._current_time)
+        self._history_items.append(self._item_ids[item_name])
+        self._history_costs.append(cost)
+        self._history_totals.append(self._total_cookies)
 
     def time_until(self, cookies):
         """
@@ -108,17 +193,71 @@ class ClickerState:
         if cost <= self._current_amount:
             self._current_amount -= cost
             self._current_cps += additional_cps
-            self._history.append((self._current_time, item_name, cost, self._total_cookies))
+            self._record(item_name, cost)
+
+
+
+class BuildView:
+    """
+    Read-only view of a BuildInfo for strategies.  Costs and cps are
+    cached and only the bought item is refreshed on update_item, so
+    strategies can read them without cloning the build.
+    """
+
+    def __init__(self, build_info):
+        """
+        Wrap build_info, which the view updates as items are bought
+        """
+        self._build_info = build_info
+        self._items = build_info.build_items()
+        self._costs = {}
+        self._cps = {}
+        for item in self._items:
+            self._costs[item] = build_info.get_cost(item)
+            self._cps[item] = build_info.get_cps(item)
+
+    def build_items(self):
+        """
+        Return the list of items.  The list is shared, do not modify it.
+        """
+        return self._items
+
+    def get_cost(self, item):
+        """
+        Return the current cost of item
+        """
+        return self._costs[item]
+
+    def get_cps(self, item):
+        """
+        Return the cps of item
+        """
+        return self._cps[item]
+
+    def update_item(self, item):
+        """
+        Update the wrapped BuildInfo after item is bought and refresh
+        the cached values for item
+        """
+        self._build_info.update_item(item)
+        self._costs[item] = self._build_info.get_cost(item)
+        self._cps[item] = self._build_info.get_cps(item)
+
+    def clone(self):
+        """
+        Return a clone of the wrapped BuildInfo
+        """
+        return self._build_info.clone()
             
             
-def simulate_clicker(build_info, duration, strategy):
+def simulate_clicker(build_info, duration, strategy, history_mode = HISTORY_FULL):
     """
     Function to run a Cookie Clicker game for the given
     duration with the given strategy.  Returns a ClickerState
     object corresponding to game.
     """
-    build_clone = build_info.clone()
-    clicker = ClickerState()
+    build_clone = BuildView(build_info.clone())
+    clicker = ClickerState(history_mode)
     stop = False
     while clicker.get_time() <= duration and stop == False:
         time_left = duration - clicker.get_time()
@@ -146,6 +285,126 @@ def simulate_clicker(build_info, duration, strategy):
     return clicker
 
 
+class ItemQueue:
+    """
+    Items of a BuildInfo kept sorted for one of the stateless
+    strategies, so the strategy's choice is found without scanning
+    and cloning the build every purchase.
+    """
+
+    def __init__(self, build_info, strategy_name):
+        """
+        strategy_name is "cheap", "expensive" or "best"
+        """
+        self._build_info = build_info
+        self._strategy_name = strategy_name
+        self._items = build_info.build_items()
+        self._indices = dict([(self._items[index], index) for index in range(len(self._items))])
+        self._keys = {}
+        self._order = []
+        for index in range(len(self._items)):
+            key = self._key(index)
+            self._keys[self._items[index]] = key
+            bisect.insort(self._order, key)
+
+    def _key(self, index):
+        """
+        Return the sort key of the item at the given build_items index.
+        Keys break ties on index the same way the strategies do, and
+        for "best" also carry the cost so choose need not look it up.
+        """
+        item = self._items[index]
+        cost = self._build_info.get_cost(item)
+        if self._strategy_name == "cheap":
+            return (cost, index)
+        elif self._strategy_name == "expensive":
+            return (cost, -index)
+        else:
+            return (-(self._build_info.get_cps(item) / cost), index, cost)
+
+    def choose(self, cookies, cps, time_left):
+        """
+        Return the item the strategy would pick, or None
+        """
+        affordability = cookies + cps * time_left
+        if not self._order:
+            return None
+        if self._strategy_name == "cheap":
+            key = self._order[0]
+            if key[0] <= affordability:
+                return self._items[key[1]]
+        elif self._strategy_name == "expensive":
+            position = bisect.bisect_right(self._order, (affordability, float("inf"))) - 1
+            if position >= 0:
+                return self._items[-self._order[position][1]]
+        else:
+            # Usually the first item is affordable
+            for key in self._order:
+                if key[2] <= affordability:
+                    return self._items[key[1]]
+        return None
+
+    def update_item(self, item):
+        """
+        Update the item in the BuildInfo after a purchase and move it
+        to its new place in the order
+        """
+        order = self._order
+        position = bisect.bisect_left(order, self._keys[item])
+        self._build_info.update_item(item)
+        key = self._key(self._indices[item])
+        self._keys[item] = key
+        # Keep the item in place when it stays between its neighbors,
+        # as in runs of the same purchase
+        if ((position == 0 or order[position - 1] < key) and
+                (position == len(order) - 1 or key < order[position + 1])):
+            order[position] = key
+        else:
+            del order[position]
+            bisect.insort(order, key)
+
+
+def simulate_clicker_fast(build_info, duration, strategy, history_mode = HISTORY_FULL):
+    """
+    Same as simulate_clicker, but for the stateless strategies cheap,
+    expensive and best the choice comes from an ItemQueue instead of
+    calling the strategy.  The returned ClickerState and history match
+    simulate_clicker exactly.  Other strategies use simulate_clicker.
+
+    Purchases are still made one at a time: each is recorded and its
+    rounded wait changes the state the next one sees, so runs of
+    purchases cannot be summed in closed form without changing the
+    results.  Cheap and best rarely buy the same item twice in a row
+    anyway.
+    """
+    strategy_names = {strategy_cheap: "cheap",
+                      strategy_expensive: "expensive",
+                      strategy_best: "best"}
+    if strategy not in strategy_names:
+        return simulate_clicker(build_info, duration, strategy, history_mode)
+
+    build_clone = build_info.clone()
+    queue = ItemQueue(build_clone, strategy_names[strategy])
+    clicker = ClickerState(history_mode)
+    while clicker.get_time() <= duration:
+        time_left = duration - clicker.get_time()
+        item = queue.choose(clicker.get_cookies(), clicker.get_cps(), time_left)
+        if item == None:
+            break
+        cost = build_clone.get_cost(item)
+        wait_time = clicker.time_until(cost)
+        if wait_time > time_left:
+            break
+        # Jump straight to the moment the item is affordable
+        clicker.wait(wait_time)
+        clicker.buy_item(item, cost, build_clone.get_cps(item))
+        queue.update_item(item)
+
+    time_left = duration - clicker.get_time()
+    clicker.wait(time_left)
+    return clicker
+
+
 def strategy_cursor(cookies, cps, time_left, build_info):
     """
     Always pick Cursor!
@@ -170,30 +429,28 @@ def strategy_cheap(cookies, cps, time_left, build_info):
     """
     Returns the cheapest item you can afford
     """
-    clone = build_info.clone()
-    items = clone.build_items()
     affordability = cookies + cps * time_left
     min_item = None
     min_item_cost = float("inf")
-    for element in items:
-        if clone.get_cost(element) < min_item_cost and clone.get_cost(element) <= affordability:
+    for element in build_info.build_items():
+        cost = build_info.get_cost(element)
+        if cost < min_item_cost and cost <= affordability:
             min_item = element
-            min_item_cost = clone.get_cost(element)
+            min_item_cost = cost
     return min_item
 
 def strategy_expensive(cookies, cps, time_left, build_info):
     """
     Returns the most expensive item you can afford
     """
-    clone = build_info.clone()
-    items = clone.build_items()
     affordability = cookies + cps * time_left
     max_item = None
     max_item_cost = float("-inf")
-    for element in items:
-        if clone.get_cost(element) > max_item_cost and clone.get_cost(element) <= affordability:
+    for element in build_info.build_items():
+        cost = build_info.get_cost(element)
+        if cost > max_item_cost and cost <= affordability:
             max_item = element
-            max_item_cost = clone.get_cost(element)
+            max_item_cost = cost
     return max_item
 
 def strategy_best(cookies, cps, time_left, build_info):
@@ -201,17 +458,133 @@ def strategy_best(cookies, cps, time_left, build_info):
     Best strategy returning the item with the highest production
     per cost
     """
-    clone = build_info.clone()
-    items = clone.build_items()
     affordability = cookies + cps * time_left
     best_item = None
     max_cps_cost = float("-inf")
-    for element in items:
-        cps_cost = clone.get_cps(element)/clone.get_cost(element)
-        if cps_cost > max_cps_cost and clone.get_cost(element) <= affordability:
+    for element in build_info.build_items():
+        cost = build_info.get_cost(element)
+        cps_cost = build_info.get_cps(element)/cost
+        if cps_cost > max_cps_cost and cost <= affordability:
             max_cps_cost = cps_cost
             best_item = element
     return best_item
+
+def _planner_bound(total, cookies, cps, time_left, ratio):
+    """
+    Upper bound on the final total cookies from a planner state.
+    Each cookie spent adds at most ratio cps, so production P obeys
+    P' <= cps + ratio * (cookies + P), which integrates in closed form.
+    The bound grows as exp(ratio * time_left), so it is only useful
+    for short durations; when ratio * time_left exceeds 700 it is
+    infinite.
+    """
+    if ratio <= 0.0:
+        return total + cps * time_left
+    if ratio * time_left > 700.0:
+        return float("inf")
+    rate = cps + ratio * cookies
+    return total + rate / ratio * (math.exp(ratio * time_left) - 1.0)
+
+def plan_purchases(build_info, duration, max_nodes = 100000):
+    """
+    Search purchase sequences for the one that ends with the most
+    total cookies after duration, using the same wait-then-buy rules
+    as simulate_clicker.
+
+    The search goes breadth first, one purchase per layer, seeded
+    with the strategy_best schedule.  States with the same item
+    counts have the same cps and the same cookies spent, so within a
+    layer a state is dropped when another reaches those counts no
+    later and with at least as many cookies once it catches up.
+    Because a layer is complete before it is expanded, no state is
+    expanded and later beaten, which the old depth first order did
+    over and over.  Branches whose upper bound cannot beat the best
+    schedule are cut.  At most max_nodes states are expanded.
+
+    The bound grows exponentially with the time left, so it prunes
+    little past a few thousand seconds; the search finishes at
+    durations up to about a thousand with the provided BuildInfo and
+    runs out of nodes at SIM_TIME.
+
+    Returns a tuple of the best final total cookies, the list of
+    items to buy in order and whether the search finished.  Only a
+    finished search is known to be optimal; otherwise the schedule
+    is the best found within max_nodes.
+    """
+    greedy = simulate_clicker(build_info, duration, strategy_best)
+    best_total = greedy.get_total_cookies()
+    best_schedule = [entry[1] for entry in greedy.get_history()[1:]]
+
+    items = build_info.build_items()
+    item_cps = [build_info.get_cps(item) for item in items]
+    # costs[index][count] is the cost of the item after count purchases
+    costs = [[build_info.get_cost(item)] for item in items]
+    stepper = build_info.clone()
+
+    # Maps item counts to the non-dominated states that reach them,
+    # each (time, cookies, cps, total, schedule) where schedule is a
+    # linked list of (item index, rest of schedule)
+    layer = {(0,) * len(items): [(0.0, 0.0, 1.0, 0.0, None)]}
+    nodes = 0
+    while layer and nodes < max_nodes:
+        next_layer = {}
+        for counts, states in layer.items():
+            for time, cookies, cps, total, schedule in states:
+                if nodes >= max_nodes:
+                    break
+                nodes += 1
+                time_left = duration - time
+
+                final_total = total + cps * time_left
+                if final_total > best_total:
+                    best_total = final_total
+                    best_schedule = []
+                    link = schedule
+                    while link != None:
+                        best_schedule.append(items[link[0]])
+                        link = link[1]
+                    best_schedule.reverse()
+
+                ratios = [item_cps[index] / costs[index][counts[index]]
+                          for index in range(len(items))]
+                if _planner_bound(total, cookies, cps, time_left, max(ratios)) <= best_total:
+                    continue
+
+                for index in range(len(items)):
+                    count = counts[index]
+                    cost = costs[index][count]
+                    if cookies >= cost:
+                        wait = 0.0
+                    else:
+                        wait = math.ceil((cost - cookies) / cps)
+                    if wait > time_left or cookies + cps * wait < cost:
+                        continue
+                    if len(costs[index]) == count + 1:
+                        stepper.update_item(items[index])
+                        costs[index].append(stepper.get_cost(items[index]))
+                    new_time = time + wait
+                    new_cookies = cookies + cps * wait - cost
+                    new_cps = cps + item_cps[index]
+                    # Same counts means same cps, so compare cookies
+                    # shifted back to time zero
+                    value = new_cookies - new_cps * new_time
+                    new_counts = counts[:index] + (count + 1,) + counts[index + 1:]
+                    frontier = next_layer.setdefault(new_counts, [])
+                    dominated = False
+                    for other in frontier:
+                        if other[0] <= new_time and other[1] - other[2] * other[0] >= value:
+                            dominated = True
+                            break
+                    if dominated:
+                        continue
+                    frontier[:] = [other for other in frontier
+                                   if not (new_time <= other[0] and
+                                           value >= other[1] - other[2] * other[0])]
+                    frontier.append((new_time, new_cookies, new_cps,
+                                     total + cps * wait, (index, schedule)))
+        layer = next_layer
+
+    return best_total, best_schedule, nodes < max_nodes
         
     
 def run_strategy(strategy_name, time, strategy):
@@ -230,6 +603,50 @@ def run_strategy(strategy_name, time, strategy):
     # history = [(item[0], item[3]) for item in history]
     # simpleplot.plot_lines(strategy_name, 1000, 400, 'Time', 'Total Cookies', [history], True)
 
+def _run_tournament_cell(cell):
+    """
+    Run one simulation for run_tournament and return its table row
+    """
+    strategy_name, strategy, duration, build_name, build_info = cell
+    start = time.time()
+    state = simulate_clicker(build_info, duration, strategy, HISTORY_OFF)
+    return {"strategy": strategy_name,
+            "duration": duration,
+            "build": build_name,
+            "total_cookies": state.get_total_cookies(),
+            "cookies": state.get_cookies(),
+            "cps": state.get_cps(),
+            "wall_time": time.time() - start}
+
+def run_tournament(strategies, durations, builds, processes = None):
+    """
+    Simulate every strategy for every duration on every build.
+
+    strategies: list of (name, strategy function) pairs
+    durations: list of simulation times
+    builds: list of (name, BuildInfo) pairs
+    processes: number of worker processes, None for one per core
+
+    Returns a list of dictionaries, one per run, with the keys
+    strategy, duration, build, total_cookies, cookies, cps and
+    wall_time.  Runs happen serially if no process pool is available.
+    """
+    cells = []
+    for strategy_name, strategy in strategies:
+        for duration in durations:
+            for build_name, build_info in builds:
+                cells.append((strategy_name, strategy, duration, build_name, build_info))
+
+    if multiprocessing == None or processes == 1:
+        return [_run_tournament_cell(cell) for cell in cells]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_run_tournament_cell, cells)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
 def run():
     """
     Run the simulator.
@@ -241,4 +658,11 @@ def run():
     run_strategy("Expensive", SIM_TIME, strategy_expensive)
     run_strategy("Best", SIM_TIME, strategy_best)
 
-run()
+    # Uncomment to compare all strategies at once
+    # strategies = [("Cursor", strategy_cursor), ("Cheap", strategy_cheap),
+    #               ("Expensive", strategy_expensive), ("Best", strategy_best)]
+    # for row in run_tournament(strategies, [SIM_TIME], [("Default", provided.BuildInfo())]):
+    #     print row
+
+if __name__ == "__main__":
+    run()
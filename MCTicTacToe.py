@@ -1,24 +1,183 @@
 """
 Monte Carlo Tic-Tac-Toe Player
 """
+import math
 import random
-import poc_ttt_gui
+import time
 import poc_ttt_provided as provided
 
+# Parallel trials run in a process pool where one is available
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 # Constants for Monte Carlo simulator
 NTRIALS = 100 # Number of trials to run
 MCMATCH = 1.0  # Score for squares played by the machine player
 MCOTHER = 1.0  # Score for squares played by the other player
+MCCHUNKS = 16  # Number of seeded batches parallel trials are split into
+UCTEXPLORE = 1.4  # Exploration constant for UCT tree search
+REVERSED = False  # Whether games are reversed, so three in a row loses
+
+# Lines of each board size used by PlayoutBoard, keyed by dimension
+PLAYOUT_LINES = {}
+
+class PlayoutBoard:
+    """
+    Compact board for random playouts with the same interface as
+    provided.TTTBoard.  Squares are kept in a flat list, empty squares
+    in a list that is updated on every move, and each line counts the
+    pieces of each player so a move only checks the lines through it.
+    """
+
+    def __init__(self, dim, reverse = False, board = None):
+        """
+        Create an empty dim x dim board, or a copy of board, a grid of
+        squares like the one TTTBoard takes
+        """
+        if dim not in PLAYOUT_LINES:
+            lines = [[row * dim + col for col in range(dim)] for row in range(dim)]
+            lines.extend([[row * dim + col for row in range(dim)] for col in range(dim)])
+            lines.append([idx * dim + idx for idx in range(dim)])
+            lines.append([idx * dim + dim - 1 - idx for idx in range(dim)])
+            lines_through = [[line for line in range(len(lines)) if cell in lines[line]]
+                             for cell in range(dim * dim)]
+            PLAYOUT_LINES[dim] = (len(lines), lines_through)
+        self._dim = dim
+        self._reverse = reverse
+        self._num_lines, self._lines_through = PLAYOUT_LINES[dim]
+        self._cells = [provided.EMPTY] * (dim * dim)
+        # Empty squares as (row, col) and each cell's index in that list
+        self._empty = [(cell // dim, cell % dim) for cell in range(dim * dim)]
+        self._empty_index = list(range(dim * dim))
+        self._line_counts = {provided.PLAYERX: [0] * self._num_lines,
+                             provided.PLAYERO: [0] * self._num_lines}
+        self._winner = None
+        if board != None:
+            for row in range(dim):
+                for col in range(dim):
+                    if board[row][col] != provided.EMPTY:
+                        self.move(row, col, board[row][col])
+
+    def __str__(self):
+        """
+        Human readable representation of the board
+        """
+        return provided.TTTBoard(self._dim, self._reverse, self.get_grid()).__str__()
+
+    def get_grid(self):
+        """
+        Return the squares as a list of rows
+        """
+        dim = self._dim
+        return [self._cells[row * dim:(row + 1) * dim] for row in range(dim)]
+
+    def get_dim(self):
+        """
+        Return the dimension of the board
+        """
+        return self._dim
+
+    def square(self, row, col):
+        """
+        Return the status of the square at (row, col)
+        """
+        return self._cells[row * self._dim + col]
+
+    def get_empty_squares(self):
+        """
+        Return the list of empty squares as (row, col) tuples.  The
+        list is shared with the board, do not modify it.
+        """
+        return self._empty
+
+    def move(self, row, col, player):
+        """
+        Place player on (row, col) if it is empty and update the empty
+        squares, line counts and winner
+        """
+        cell = row * self._dim + col
+        if self._cells[cell] != provided.EMPTY:
+            return
+        self._cells[cell] = player
+
+        index = self._empty_index[cell]
+        last_square = self._empty.pop()
+        if index < len(self._empty):
+            self._empty[index] = last_square
+            self._empty_index[last_square[0] * self._dim + last_square[1]] = index
+
+        counts = self._line_counts[player]
+        for line in self._lines_through[cell]:
+            counts[line] += 1
+            if counts[line] == self._dim and self._winner == None:
+                self._winner = player
+
+    def check_win(self):
+        """
+        Return the winner, provided.DRAW if the board is full, or None
+        """
+        if self._winner != None:
+            if self._reverse:
+                return provided.switch_player(self._winner)
+            return self._winner
+        if not self._empty:
+            return provided.DRAW
+        return None
+
+    def clone(self):
+        """
+        Return a copy of the board
+        """
+        copy = PlayoutBoard(self._dim, self._reverse)
+        copy._cells = list(self._cells)
+        copy._empty = list(self._empty)
+        copy._empty_index = list(self._empty_index)
+        copy._line_counts = {provided.PLAYERX: list(self._line_counts[provided.PLAYERX]),
+                             provided.PLAYERO: list(self._line_counts[provided.PLAYERO])}
+        copy._winner = self._winner
+        return copy
+
+def board_reverse(board):
+    """
+    Return whether the game on board, which must not be over, is
+    reversed.  TTTBoard has no getter for it, so a clone is filled
+    with one player and check_win tells whether completing a line
+    won or lost.  If every line holds both players no one can
+    complete one and False is returned, as the rule does not matter.
+    """
+    for player in (provided.PLAYERX, provided.PLAYERO):
+        clone = board.clone()
+        for row, col in clone.get_empty_squares():
+            clone.move(row, col, player)
+        winner = clone.check_win()
+        if winner == player:
+            return False
+        elif winner == provided.switch_player(player):
+            return True
+    return False
+
+def playout_board(board, reverse = None):
+    """
+    Return a PlayoutBoard with the same squares and reverse rule as
+    board, which must not be over.  The rule is found with
+    board_reverse unless the caller passes it.
+    """
+    if reverse == None:
+        reverse = board_reverse(board)
+    dim = board.get_dim()
+    return PlayoutBoard(dim, reverse, [[board.square(row, col) for col in range(dim)] for row in range(dim)])
     
-def mc_trial(board, player):
+def mc_trial(board, player, rng = random):
     """
     Plays a game with alternating players, with the parameter
-    "player" being the first to go
+    "player" being the first to go.  Moves are drawn from rng.
     """
     progress = board.check_win()
     while progress == None:
         empty_squares = board.get_empty_squares()
-        square = random.choice(empty_squares)
+        square = rng.choice(empty_squares)
         board.move(square[0], square[1], player)
         player = provided.switch_player(player)
         progress = board.check_win()
@@ -49,10 +208,10 @@ def mc_update_scores(scores, board, player):
                     if board.square(row, col) != player and board.square(row, col) != provided.EMPTY:
                         scores[row][col] += MCOTHER
 
-def get_best_move(board, scores):
+def get_best_move(board, scores, rng = random):
     """
     Returns an empty square with the maximum amount of points
-    as determined by scores
+    as determined by scores, breaking ties with rng
     """
     empty_squares = board.get_empty_squares()
     best_squares = []
@@ -66,23 +225,281 @@ def get_best_move(board, scores):
             best_squares = []
             best_squares.append(square)
             
-    return random.choice(best_squares)
+    return rng.choice(best_squares)
 
-def mc_move(board, player, trials):
+def mc_move(board, player, trials, reverse = None):
     """
     Uses a Monte Carlo simulation to return a move for the
-    machine player
+    machine player.  reverse is as for playout_board.
     """
     scores = [[0 for dummy_x in xrange(board.get_dim())] for dummy_y in xrange(board.get_dim())]
+    start = playout_board(board, reverse)
     for dummy_trial in range(trials):
-        copy = board.clone()
+        copy = start.clone()
         mc_trial(copy, player)
         mc_update_scores(scores, copy, player)
     return get_best_move(board, scores)
 
+def _mc_chunk(task):
+    """
+    Run one seeded batch of trials for mc_move_parallel and return
+    its score grid
+    """
+    board, player, trials, seed, reverse = task
+    rng = random.Random(seed)
+    scores = [[0 for dummy_x in xrange(board.get_dim())] for dummy_y in xrange(board.get_dim())]
+    start = playout_board(board, reverse)
+    for dummy_trial in range(trials):
+        copy = start.clone()
+        mc_trial(copy, player, rng)
+        mc_update_scores(scores, copy, player)
+    return scores
+
+def mc_move_parallel(board, player, trials, seed = None, processes = None,
+                     reverse = None):
+    """
+    Monte Carlo move with the trials split into MCCHUNKS batches run
+    over a process pool.  Batch i is seeded with seed + i, so a given
+    seed always gives the same move whatever the number of processes.
+    Batches run serially if no process pool is available.  reverse
+    is as for playout_board.
+    """
+    if seed == None:
+        seed = random.randrange(2 ** 30)
+    tasks = []
+    for chunk in range(MCCHUNKS):
+        chunk_trials = trials // MCCHUNKS
+        if chunk < trials % MCCHUNKS:
+            chunk_trials += 1
+        if chunk_trials:
+            tasks.append((board, player, chunk_trials, seed + chunk, reverse))
+
+    if multiprocessing == None or processes == 1:
+        grids = [_mc_chunk(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            grids = pool.map(_mc_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    dim = board.get_dim()
+    scores = [[0 for dummy_x in xrange(dim)] for dummy_y in xrange(dim)]
+    for grid in grids:
+        for row in range(dim):
+            for col in range(dim):
+                scores[row][col] += grid[row][col]
+    return get_best_move(board, scores, random.Random(seed))
+
+
+class UCTTree:
+    """
+    UCT search tree stored in parallel lists indexed by node, with
+    node 0 as the root.  After each move the subtree of the position
+    reached is copied into fresh lists and searched further.
+    """
+
+    def __init__(self):
+        """
+        Create an empty tree
+        """
+        self._root_board = None
+        self._reverse = None
+        self._parent = []
+        self._move = []
+        self._mover = []
+        self._visits = []
+        self._wins = []
+        self._children = []
+        self._untried = []
+
+    def _add_node(self, parent, move, mover, board):
+        """
+        Append a node for the position board reached by mover playing
+        move, and return its index
+        """
+        self._parent.append(parent)
+        self._move.append(move)
+        self._mover.append(mover)
+        self._visits.append(0)
+        self._wins.append(0.0)
+        self._children.append([])
+        if board.check_win() == None:
+            self._untried.append(list(board.get_empty_squares()))
+        else:
+            self._untried.append([])
+        return len(self._parent) - 1
+
+    def _reset(self, board, player):
+        """
+        Start a new tree for board with player to move
+        """
+        self.__init__()
+        self._root_board = board
+        self._add_node(-1, None, provided.switch_player(player), board)
+
+    def _find_node(self, board, player):
+        """
+        Return the node for board with player to move if the tree
+        already contains it, or None
+        """
+        if self._root_board == None or self._root_board.get_dim() != board.get_dim():
+            return None
+        dim = board.get_dim()
+        added = []
+        for row in range(dim):
+            for col in range(dim):
+                before = self._root_board.square(row, col)
+                if before != board.square(row, col):
+                    if before != provided.EMPTY:
+                        return None
+                    added.append((row, col))
+        node = 0
+        while added:
+            next_node = None
+            for child in self._children[node]:
+                if self._move[child] in added and board.square(*self._move[child]) == self._mover[child]:
+                    next_node = child
+                    break
+            if next_node == None:
+                return None
+            added.remove(self._move[next_node])
+            node = next_node
+        if self._mover[node] == player:
+            return None
+        return node
+
+    def _reroot(self, node, board):
+        """
+        Keep only the subtree below node, copied into fresh lists
+        """
+        old = (self._parent, self._move, self._mover, self._visits,
+               self._wins, self._children, self._untried)
+        self.__init__()
+        self._root_board = board
+        queue = [(node, -1)]
+        head = 0
+        while head < len(queue):
+            old_node, new_parent = queue[head]
+            head += 1
+            self._parent.append(new_parent)
+            self._move.append(old[1][old_node])
+            self._mover.append(old[2][old_node])
+            self._visits.append(old[3][old_node])
+            self._wins.append(old[4][old_node])
+            self._children.append([])
+            self._untried.append(list(old[6][old_node]))
+            new_node = len(self._parent) - 1
+            if new_parent >= 0:
+                self._children[new_parent].append(new_node)
+            for child in old[5][old_node]:
+                queue.append((child, new_node))
+
+    def _select_child(self, node):
+        """
+        Return the child of node with the highest UCT value
+        """
+        log_visits = math.log(self._visits[node])
+        best_child = None
+        best_value = float("-inf")
+        for child in self._children[node]:
+            visits = self._visits[child]
+            value = self._wins[child] / visits + UCTEXPLORE * math.sqrt(log_visits / visits)
+            if value > best_value:
+                best_value = value
+                best_child = child
+        return best_child
+
+    def search(self, board, player, trials, rng = random, reverse = None):
+        """
+        Run trials iterations of UCT from board with player to move,
+        reusing the tree from the previous search when board follows
+        from it under the same reverse rule.  reverse is as for
+        playout_board.
+
+        Returns the most visited move as (row, col)
+        """
+        start = playout_board(board, reverse)
+        root = self._find_node(board, player)
+        if root == None or reverse != self._reverse:
+            self._reset(board.clone(), player)
+        else:
+            self._reroot(root, board.clone())
+        self._reverse = reverse
+
+        for dummy_trial in range(trials):
+            node = 0
+            current = start.clone()
+            # Selection
+            while not self._untried[node] and self._children[node]:
+                node = self._select_child(node)
+                current.move(self._move[node][0], self._move[node][1], self._mover[node])
+            # Expansion
+            if self._untried[node]:
+                untried = self._untried[node]
+                index = rng.randrange(len(untried))
+                move = untried[index]
+                untried[index] = untried[-1]
+                untried.pop()
+                mover = provided.switch_player(self._mover[node])
+                current.move(move[0], move[1], mover)
+                child = self._add_node(node, move, mover, current)
+                self._children[node].append(child)
+                node = child
+            # Simulation
+            mc_trial(current, provided.switch_player(self._mover[node]), rng)
+            winner = current.check_win()
+            # Backpropagation
+            while node >= 0:
+                self._visits[node] += 1
+                if winner == self._mover[node]:
+                    self._wins[node] += 1.0
+                elif winner == provided.DRAW:
+                    self._wins[node] += 0.5
+                node = self._parent[node]
+
+        best_child = None
+        for child in self._children[0]:
+            if best_child == None or self._visits[child] > self._visits[best_child]:
+                best_child = child
+        if best_child == None:
+            return rng.choice(board.get_empty_squares())
+        return self._move[best_child]
+
+# Tree kept between moves by uct_move
+UCT_TREE = UCTTree()
+
+def uct_move(board, player, trials, reverse = None):
+    """
+    Uses UCT tree search with the given number of playouts to return a
+    move for the machine player, reusing the search tree from its
+    previous move when possible.  reverse is as for playout_board.
+    """
+    return UCT_TREE.search(board, player, trials, reverse = reverse)
+
+def benchmark_playouts(dim = 3, trials = 2000):
+    """
+    Print playouts per second on provided.TTTBoard and on PlayoutBoard
+    """
+    rates = []
+    for name, board in [("TTTBoard", provided.TTTBoard(dim)), ("PlayoutBoard", PlayoutBoard(dim))]:
+        scores = [[0 for dummy_x in xrange(dim)] for dummy_y in xrange(dim)]
+        start = time.time()
+        for dummy_trial in range(trials):
+            copy = board.clone()
+            mc_trial(copy, provided.PLAYERX)
+            mc_update_scores(scores, copy, provided.PLAYERX)
+        rate = trials / max(time.time() - start, 1e-9)
+        rates.append(rate)
+        print name, dim, "x", dim, ":", int(rate), "playouts/sec"
+    print "Speedup:", rates[1] / rates[0]
 
+if __name__ == "__main__":
+    import poc_ttt_gui
 
-#Uncomment whichever you prefer
+    #Uncomment whichever you prefer
 
-#provided.play_game(mc_move, NTRIALS, False)
-poc_ttt_gui.run_gui(3, provided.PLAYERO, mc_move, NTRIALS, False)
+    #provided.play_game(mc_move, NTRIALS, REVERSED)
+    #poc_ttt_gui.run_gui(3, provided.PLAYERO, uct_move, NTRIALS, REVERSED)
+    poc_ttt_gui.run_gui(3, provided.PLAYERO, mc_move, NTRIALS, REVERSED)
@@ -5,6 +5,7 @@ Mini-max Tic-Tac-Toe Player
 import poc_ttt_gui
 import poc_ttt_provided as provided
 import random
+import time
 
 # Set timeout, as mini-max can take a long time
 import codeskulptor
@@ -15,6 +16,21 @@ SCORES = {provided.PLAYERX: 1,
           provided.DRAW: 0,
           provided.PLAYERO: -1}
 
+# Opening book of perfect play for 3x3 boards, one line per canonical
+# position: board and player to move as characters, best cell, score
+BOOK_FILE = "ttt_book.txt"
+BOOK_CHARS = {provided.EMPTY: ".", provided.PLAYERX: "X", provided.PLAYERO: "O"}
+OPENING_BOOK = {}
+
+# Transposition table bound types for the alpha-beta search
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# Each alpha-beta search clears its transposition table when it grows
+# past TABLE_SIZE entries, as searches are kept between moves and games
+TABLE_SIZE = 500000
+
 def mm_move(board, player):
     """
     Make a move on the board.
@@ -26,6 +42,20 @@ def mm_move(board, player):
     winner = board.check_win()
     if winner != None:
         return SCORES[winner], (-1, -1)
+
+    entry = book_move(board, player)
+    if entry != None:
+        return entry
+    return _mm_search(board, player)
+
+def _mm_search(board, player):
+    """
+    Plain mini-max for mm_move.  A board the opening book misses has
+    no later positions in it either, so the book is not looked up.
+    """
+    winner = board.check_win()
+    if winner != None:
+        return SCORES[winner], (-1, -1)
         
     empty_squares = board.get_empty_squares()
     if len(empty_squares) == board.get_dim() ** 2:
@@ -37,7 +67,7 @@ def mm_move(board, player):
     for square in empty_squares:
         clone = board.clone()
         clone.move(square[0], square[1], player)
-        clone_move = mm_move(clone, provided.switch_player(player))
+        clone_move = _mm_search(clone, provided.switch_player(player))
         score = SCORES[player] * clone_move[0]
         if score == 1:
             return clone_move[0], square
@@ -49,16 +79,482 @@ def mm_move(board, player):
             best_move = square
     return best_score, best_move
 
+def board_reverse(board):
+    """
+    Return whether the game on board, which must not be over, is
+    reversed.  TTTBoard has no getter for it, so a clone is filled
+    with one player and check_win tells whether completing a line
+    won or lost.  If every line holds both players no one can
+    complete one and False is returned, as the rule does not matter.
+    """
+    for player in (provided.PLAYERX, provided.PLAYERO):
+        clone = board.clone()
+        for row, col in clone.get_empty_squares():
+            clone.move(row, col, player)
+        winner = clone.check_win()
+        if winner == player:
+            return False
+        elif winner == provided.switch_player(player):
+            return True
+    return False
+
+def board_lines(dim):
+    """
+    Return the rows, columns and diagonals of a dim x dim board as
+    lists of flat cell indices
+    """
+    lines = []
+    for row in range(dim):
+        lines.append([row * dim + col for col in range(dim)])
+    for col in range(dim):
+        lines.append([row * dim + col for row in range(dim)])
+    lines.append([idx * dim + idx for idx in range(dim)])
+    lines.append([idx * dim + dim - 1 - idx for idx in range(dim)])
+    return lines
+
+def board_symmetries(dim):
+    """
+    Return the 8 rotations and reflections of a dim x dim board as
+    permutations of flat cell indices
+    """
+    last = dim - 1
+    transforms = [lambda row, col: (row, col),
+                  lambda row, col: (col, last - row),
+                  lambda row, col: (last - row, last - col),
+                  lambda row, col: (last - col, row),
+                  lambda row, col: (row, last - col),
+                  lambda row, col: (last - row, col),
+                  lambda row, col: (col, row),
+                  lambda row, col: (last - col, last - row)]
+    symmetries = []
+    for transform in transforms:
+        permutation = []
+        for row in range(dim):
+            for col in range(dim):
+                new_row, new_col = transform(row, col)
+                permutation.append(new_row * dim + new_col)
+        symmetries.append(permutation)
+    return symmetries
+
+class AlphaBetaSearch:
+    """
+    Negamax search with alpha-beta pruning on a flat copy of a board.
+    Moves are made and unmade in place, and positions are stored in a
+    transposition table under their canonical form over the 8 board
+    symmetries.  In a reversed game completing a line loses.
+    """
+
+    def __init__(self, dim, reverse = False):
+        """
+        Precompute lines, symmetries and move order for dim x dim boards
+        """
+        self._dim = dim
+        # Value for the player who completes a line
+        if reverse:
+            self._line_value = -1
+        else:
+            self._line_value = 1
+        self._size = dim * dim
+        self._lines = board_lines(dim)
+        self._lines_through = [[line for line in self._lines if cell in line]
+                               for cell in range(self._size)]
+        self._symmetries = board_symmetries(dim)
+        # Cells on more lines (center, then corners) are tried first
+        self._move_order = sorted(range(self._size),
+                                  key = lambda cell: -len(self._lines_through[cell]))
+        self._table = {}
+        self._cells = [provided.EMPTY] * self._size
+        self._num_empty = self._size
+        self._deadline = None
+        self._timed_out = False
+        # Search statistics for the last search_until call
+        self._nodes = 0
+        self._probes = 0
+        self._hits = 0
+
+    def set_board(self, board):
+        """
+        Copy the squares of a TTTBoard into the search
+        """
+        self._cells = [board.square(cell // self._dim, cell % self._dim)
+                       for cell in range(self._size)]
+        self._num_empty = self._cells.count(provided.EMPTY)
+
+    def canonical_form(self):
+        """
+        Return the smallest symmetric image of the current board and
+        the permutation that produces it, where image index i holds
+        board cell permutation[i]
+        """
+        cells = self._cells
+        return min([(tuple([cells[index] for index in permutation]), permutation)
+                    for permutation in self._symmetries])
+
+    def _canonical(self):
+        """
+        Return the smallest symmetric image of the current board
+        """
+        cells = self._cells
+        return min([tuple([cells[index] for index in permutation])
+                    for permutation in self._symmetries])
+
+    def _is_win(self, cell, player):
+        """
+        Check whether the move just made at cell won the game
+        """
+        cells = self._cells
+        for line in self._lines_through[cell]:
+            won = True
+            for index in line:
+                if cells[index] != player:
+                    won = False
+                    break
+            if won:
+                return True
+        return False
+
+    def _heuristic(self, player):
+        """
+        Score a position that is not searched further, strictly between
+        -1 and 1: lines held only by one player count for that player,
+        or against them in a reversed game
+        """
+        other = provided.switch_player(player)
+        total = 0
+        for line in self._lines:
+            mine = 0
+            theirs = 0
+            for index in line:
+                if self._cells[index] == player:
+                    mine += 1
+                elif self._cells[index] == other:
+                    theirs += 1
+            if theirs == 0:
+                total += mine * mine
+            elif mine == 0:
+                total -= theirs * theirs
+        return float(self._line_value * total) / (len(self._lines) * self._dim * self._dim + 1)
+
+    def _negamax(self, player, depth, alpha, beta):
+        """
+        Value of the position for player to move, searching depth moves
+        """
+        self._nodes += 1
+        if self._num_empty == 0:
+            return 0
+        if depth == 0:
+            return self._heuristic(player)
+        if self._deadline != None and time.time() > self._deadline:
+            self._timed_out = True
+            return 0
+
+        # Searching deeper than the number of empty squares changes nothing
+        depth = min(depth, self._num_empty)
+        key = (self._canonical(), player)
+        entry = self._table.get(key)
+        self._probes += 1
+        if entry != None and entry[0] >= depth:
+            dummy_depth, bound, value = entry
+            if bound == EXACT:
+                self._hits += 1
+                return value
+            elif bound == LOWER:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                self._hits += 1
+                return value
+
+        original_alpha = alpha
+        other = provided.switch_player(player)
+        best_value = float("-inf")
+        for cell in self._move_order:
+            if self._cells[cell] != provided.EMPTY:
+                continue
+            self._cells[cell] = player
+            self._num_empty -= 1
+            if self._is_win(cell, player):
+                value = self._line_value
+            else:
+                value = -self._negamax(other, depth - 1, -beta, -alpha)
+            self._cells[cell] = provided.EMPTY
+            self._num_empty += 1
+            if value > best_value:
+                best_value = value
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if not self._timed_out:
+            if best_value <= original_alpha:
+                bound = UPPER
+            elif best_value >= beta:
+                bound = LOWER
+            else:
+                bound = EXACT
+            if len(self._table) >= TABLE_SIZE:
+                self._table.clear()
+            self._table[key] = (depth, bound, best_value)
+        return best_value
+
+    def search_root(self, player, depth, first_cell = None):
+        """
+        Search every move for player to the given depth, trying
+        first_cell first if given.
+
+        Returns a tuple of the value for player and the best cell
+        """
+        other = provided.switch_player(player)
+        order = list(self._move_order)
+        if first_cell != None:
+            order.remove(first_cell)
+            order.insert(0, first_cell)
+        best_value = float("-inf")
+        best_cell = None
+        alpha = float("-inf")
+        for cell in order:
+            if self._cells[cell] != provided.EMPTY:
+                continue
+            self._cells[cell] = player
+            self._num_empty -= 1
+            if self._is_win(cell, player):
+                value = self._line_value
+            else:
+                value = -self._negamax(other, depth - 1, float("-inf"), -alpha)
+            self._cells[cell] = provided.EMPTY
+            self._num_empty += 1
+            if value > best_value:
+                best_value = value
+                best_cell = cell
+            alpha = max(alpha, value)
+            if best_value == 1:
+                break
+        return best_value, best_cell
+
+    def search_until(self, board, player, deadline = None, max_depth = None):
+        """
+        Search the board one level deeper at a time until max_depth
+        (default: the end of the game) or the wall-clock deadline, a
+        time.time() value, is reached.  The best move of the deepest
+        finished level is kept.
+
+        Returns a dictionary with the keys
+        score: score of the board using SCORES, a heuristic estimate
+        between -1 and 1 if the search stopped before the end of the game
+        move: best move as (row, col), (-1, -1) if the game is over
+        depth: deepest level fully searched
+        nodes: number of positions visited
+        tt_hit_rate: fraction of table probes that ended the search
+        of a position
+        elapsed: seconds spent searching
+        """
+        start = time.time()
+        self.set_board(board)
+        self._deadline = deadline
+        self._timed_out = False
+        self._nodes = 0
+        self._probes = 0
+        self._hits = 0
+
+        best_value = 0
+        best_cell = None
+        completed_depth = 0
+        winner = board.check_win()
+        if winner != None:
+            best_value = SCORES[winner] * SCORES[player]
+        else:
+            if max_depth == None:
+                max_depth = self._num_empty
+            for depth in range(1, min(max_depth, self._num_empty) + 1):
+                value, cell = self.search_root(player, depth, best_cell)
+                if self._timed_out:
+                    break
+                best_value, best_cell = value, cell
+                completed_depth = depth
+                if abs(value) == 1 or (deadline != None and time.time() > deadline):
+                    break
+            if best_cell == None:
+                best_cell = [cell for cell in self._move_order
+                             if self._cells[cell] == provided.EMPTY][0]
+
+        if best_cell == None:
+            move = (-1, -1)
+        else:
+            move = (best_cell // self._dim, best_cell % self._dim)
+        if self._probes:
+            hit_rate = float(self._hits) / self._probes
+        else:
+            hit_rate = 0.0
+        return {"score": best_value * SCORES[player],
+                "move": move,
+                "depth": completed_depth,
+                "nodes": self._nodes,
+                "tt_hit_rate": hit_rate,
+                "elapsed": time.time() - start}
+
+    def best_move(self, board, player, max_depth = None, time_limit = None):
+        """
+        Search the board like search_until, giving up after time_limit
+        seconds if given.
+
+        Returns a tuple of the score of the board, using SCORES, and
+        the best move as (row, col).  If the search stops before the
+        end of the game the score is a heuristic estimate between -1
+        and 1.
+        """
+        if time_limit != None:
+            deadline = time.time() + time_limit
+        else:
+            deadline = None
+        result = self.search_until(board, player, deadline, max_depth)
+        return result["score"], result["move"]
+
+# One search per board size and reverse rule, so the transposition
+# table is reused
+SEARCHES = {}
+
+def get_search(board):
+    """
+    Return the search in SEARCHES for the size and reverse rule of
+    board, creating it if needed
+    """
+    reverse = False
+    if board.check_win() == None:
+        reverse = board_reverse(board)
+    key = (board.get_dim(), reverse)
+    if key not in SEARCHES:
+        SEARCHES[key] = AlphaBetaSearch(board.get_dim(), reverse)
+    return SEARCHES[key]
+
+def ab_move(board, player, max_depth = None, time_limit = None):
+    """
+    Make a move on the board using alpha-beta search.
+
+    Returns a tuple with two elements like mm_move.  Searches the
+    whole game unless max_depth or time_limit (seconds) is given.
+    """
+    return get_search(board).best_move(board, player, max_depth, time_limit)
+
+def timed_move(board, player, deadline, max_depth = None):
+    """
+    Anytime alpha-beta search that returns by the wall-clock deadline
+    (a time.time() value) with the best move found so far.
+
+    Returns the dictionary of AlphaBetaSearch.search_until, with the
+    move, score and search statistics
+    """
+    return get_search(board).search_until(board, player, deadline, max_depth)
+
+def _book_key(cells, player):
+    """
+    Return the opening book key for a canonical board and player
+    """
+    return "".join([BOOK_CHARS[cell] for cell in cells]) + BOOK_CHARS[player]
+
+def solve_book():
+    """
+    Solve every position reachable on a 3x3 board, with either player
+    moving first.
+
+    Returns a dictionary from book key to the best cell and score of
+    each canonical position
+    """
+    search = AlphaBetaSearch(3)
+    book = {}
+    # Positions still to expand, as (cells, player to move)
+    stack = [(tuple([provided.EMPTY] * 9), provided.PLAYERX),
+             (tuple([provided.EMPTY] * 9), provided.PLAYERO)]
+    while stack:
+        cells, player = stack.pop()
+        board = provided.TTTBoard(3, False, [list(cells[row * 3:row * 3 + 3]) for row in range(3)])
+        if board.check_win() != None:
+            continue
+        search.set_board(board)
+        canonical, dummy_permutation = search.canonical_form()
+        key = _book_key(canonical, player)
+        if key in book:
+            continue
+        search.set_board(provided.TTTBoard(3, False, [list(canonical[row * 3:row * 3 + 3]) for row in range(3)]))
+        value, cell = search.search_root(player, canonical.count(provided.EMPTY))
+        book[key] = (cell, value * SCORES[player])
+        for index in range(9):
+            if canonical[index] == provided.EMPTY:
+                child = list(canonical)
+                child[index] = player
+                stack.append((tuple(child), provided.switch_player(player)))
+    return book
+
+def generate_book(filename = BOOK_FILE):
+    """
+    Write the opening book from solve_book to filename
+    """
+    book = solve_book()
+    book_file = open(filename, "w")
+    try:
+        for key in sorted(book.keys()):
+            book_file.write(key + " " + str(book[key][0]) + " " + str(book[key][1]) + "\n")
+    finally:
+        book_file.close()
+
+def load_book(filename = BOOK_FILE):
+    """
+    Read an opening book written by generate_book into OPENING_BOOK.
+    If the file cannot be read, the book is solved in memory instead,
+    which takes a fraction of a second.
+    """
+    OPENING_BOOK.clear()
+    try:
+        book_file = open(filename)
+    except IOError:
+        print "Opening book", filename, "not found, solving it in memory"
+        OPENING_BOOK.update(solve_book())
+        return
+    try:
+        for line in book_file:
+            fields = line.split()
+            if len(fields) == 3:
+                OPENING_BOOK[fields[0]] = (int(fields[1]), int(fields[2]))
+    finally:
+        book_file.close()
+    assert OPENING_BOOK, "opening book " + filename + " is empty"
+
+def book_move(board, player):
+    """
+    Look up a 3x3 board in the opening book, which is solved for
+    games that are not reversed.
+
+    Returns a tuple like mm_move, or None if the board is not in the
+    book
+    """
+    if board.get_dim() != 3 or not OPENING_BOOK or board_reverse(board):
+        return None
+    search = get_search(board)
+    search.set_board(board)
+    canonical, permutation = search.canonical_form()
+    entry = OPENING_BOOK.get(_book_key(canonical, player))
+    if entry == None:
+        return None
+    cell = permutation[entry[0]]
+    return entry[1], (cell // 3, cell % 3)
+
 def move_wrapper(board, player, trials):
     """
     Wrapper to allow the use of the same infrastructure that was used
     for Monte Carlo Tic-Tac-Toe.
     """
-    move = mm_move(board, player)
+    move = book_move(board, player)
+    if move == None:
+        if board.get_dim() <= 3:
+            move = ab_move(board, player)
+        else:
+            move = ab_move(board, player, time_limit = 1.0)
     assert move[1] != (-1, -1), "returned illegal move (-1, -1)"
     return move[1]
 
 
+load_book()
+
 # Test game with the console or the GUI.
 # Uncomment whichever you prefer.
 
@@ -2,9 +2,17 @@
 Clone of 2048 game.
 """
 
-from random import randint
+from random import randint, Random
+import collections
+import time
 import poc_2048_gui        
 
+# The batch simulator uses NumPy where it is available
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Directions, DO NOT MODIFY
 UP = 1
 DOWN = 2
@@ -17,38 +25,199 @@ OFFSETS = {UP: (1, 0),
            DOWN: (-1, 0), 
            LEFT: (0, 1), 
            RIGHT: (0, -1)} 
+
+# Line lengths timed by benchmark(), and the most the time per tile
+# may grow from the shortest to the longest line before it fails.
+BENCH_LENGTHS = [4, 16, 64, 256, 1024]
+BENCH_SCALING_LIMIT = 4.0
+# Throughput recorded by benchmark(), and the fraction of it each
+# timing must reach.  Each timing is the best of BENCH_RUNS runs.
+BENCH_BASELINE_FILE = "bench_2048.txt"
+BENCH_TOLERANCE = 0.5
+BENCH_RUNS = 5
+
+# Lookup tables for the packed 4x4 board, built on first use.
+# Each row is 16 bits holding four 4-bit log2 tile exponents, so the
+# largest tile is PACKED_MAX_TILE.
+PACKED_MAX_TILE = 32768
+ROW_LEFT = []
+ROW_RIGHT = []
+ROW_HEURISTIC = []
+ROW_SCORE = []
+
+# Weights for the expectimax row heuristic
+HEUR_LOST_PENALTY = 200000.0
+HEUR_EMPTY = 270.0
+HEUR_MERGES = 700.0
+HEUR_MONOTONIC = 47.0
+HEUR_SUM = 11.0
+
+# Probabilities of spawning a 2 or a 4, matching new_tile
+SPAWN_PROBS = ((1, 0.9), (2, 0.1))
    
 def merge(line):
     """
     Helper function that merges a single row or column in 2048
     """
-    result = [0] * len(line)
-    merged = [False] * len(line)    
-    for count in range(len(line)):
-        result[count] = 0
-        merged[count] = False       
-        for line_count in range(len(line)):
-            if line[line_count] != 0:
-                for result_count in range(len(line)):
-                    if (result[result_count] == 0):
-                        result[result_count] = line[line_count]
-                        break        
-        for result_count2 in range(len(line) - 1):
-            if result[result_count2] == result[result_count2 + 1] and merged[result_count2] == False:
-                result[result_count2] *= 2
-                merged[result_count2] = True                
-                for result_count3 in range(result_count2 + 1, len(line) - 1):
-                    result[result_count3] = result[result_count3 + 1]
-                result[len(line) - 1] = 0
-        return result
+    result = []
+    last_tile = 0
+    for tile in line:
+        if tile == 0:
+            continue
+        if tile == last_tile:
+            result[-1] = tile * 2
+            last_tile = 0
+        else:
+            result.append(tile)
+            last_tile = tile
+    result.extend([0] * (len(line) - len(result)))
+    return result
+
+def _log2(value):
+    """
+    Return the exponent of a power-of-two tile value (0 for empty)
+    """
+    exponent = 0
+    while value > 1:
+        value >>= 1
+        exponent += 1
+    return exponent
+
+def _reverse_row(row):
+    """
+    Reverse the order of the four exponents in a packed row
+    """
+    return ((row & 0xF) << 12) | ((row & 0xF0) << 4) | ((row >> 4) & 0xF0) | (row >> 12)
+
+def _build_row_tables():
+    """
+    Fill ROW_LEFT and ROW_RIGHT with the result of moving every
+    possible packed row.  Exponents are capped at 15, so two
+    PACKED_MAX_TILE tiles merge into one PACKED_MAX_TILE tile.
+    """
+    if ROW_LEFT:
+        return
+    left = [0] * 65536
+    for row in xrange(65536):
+        exponents = [(row >> (4 * index)) & 0xF for index in range(4)]
+        tiles = [1 << exp if exp else 0 for exp in exponents]
+        result = 0
+        for index, tile in enumerate(merge(tiles)):
+            if tile:
+                result |= min(_log2(tile), 15) << (4 * index)
+        left[row] = result
+    ROW_LEFT.extend(left)
+    ROW_RIGHT.extend([_reverse_row(left[_reverse_row(row)]) for row in xrange(65536)])
+
+def _build_score_table():
+    """
+    Fill ROW_SCORE with the points scored by moving every packed row.
+    Merges pair up the same way from either end, so one table serves
+    both left and right moves.
+    """
+    if ROW_SCORE:
+        return
+    scores = [0] * 65536
+    for row in xrange(65536):
+        last_exponent = 0
+        for index in range(4):
+            exponent = (row >> (4 * index)) & 0xF
+            if exponent == 0:
+                continue
+            if exponent == last_exponent:
+                scores[row] += 1 << (exponent + 1)
+                last_exponent = 0
+            else:
+                last_exponent = exponent
+    ROW_SCORE.extend(scores)
+
+def _row_heuristic(exponents):
+    """
+    Score a single row of exponents for the expectimax player:
+    rewards empty cells, possible merges and monotonic rows
+    """
+    empty = 0
+    merges = 0
+    tile_sum = 0.0
+    for index in range(4):
+        if exponents[index] == 0:
+            empty += 1
+        tile_sum += exponents[index] ** 3.5
+        if index > 0 and exponents[index] and exponents[index] == exponents[index - 1]:
+            merges += 1
+    increasing = 0.0
+    decreasing = 0.0
+    for index in range(3):
+        left = exponents[index] ** 4
+        right = exponents[index + 1] ** 4
+        if left > right:
+            decreasing += left - right
+        else:
+            increasing += right - left
+    return (HEUR_LOST_PENALTY + HEUR_EMPTY * empty + HEUR_MERGES * merges -
+            HEUR_MONOTONIC * min(increasing, decreasing) - HEUR_SUM * tile_sum)
+
+def _build_heuristic_table():
+    """
+    Fill ROW_HEURISTIC with the heuristic value of every packed row
+    """
+    if ROW_HEURISTIC:
+        return
+    ROW_HEURISTIC.extend([_row_heuristic([(row >> (4 * index)) & 0xF for index in range(4)])
+                          for row in xrange(65536)])
+
+def _transpose(board):
+    """
+    Transpose a packed 4x4 board so rows become columns
+    """
+    part1 = board & 0xF0F00F0FF0F00F0F
+    part2 = board & 0x0000F0F00000F0F0
+    part3 = board & 0x0F0F00000F0F0000
+    board = part1 | (part2 << 12) | (part3 >> 12)
+    part1 = board & 0xFF00FF0000FF00FF
+    part2 = board & 0x00FF00FF00000000
+    part3 = board & 0x00000000FF00FF00
+    return part1 | (part2 >> 24) | (part3 << 24)
+
+def _move_rows(board, table):
+    """
+    Apply a row lookup table to each of the four rows of a packed board
+    """
+    return (table[board & 0xFFFF] |
+            (table[(board >> 16) & 0xFFFF] << 16) |
+            (table[(board >> 32) & 0xFFFF] << 32) |
+            (table[(board >> 48) & 0xFFFF] << 48))
+
+def move_packed(board, direction):
+    """
+    Move all tiles of a packed 4x4 board in the given direction
+    Returns the new packed board
+    """
+    if direction == LEFT:
+        return _move_rows(board, ROW_LEFT)
+    elif direction == RIGHT:
+        return _move_rows(board, ROW_RIGHT)
+    elif direction == UP:
+        return _transpose(_move_rows(_transpose(board), ROW_LEFT))
+    else:
+        return _transpose(_move_rows(_transpose(board), ROW_RIGHT))
 
 class TwentyFortyEight:
     """
     Class to run the game logic.
     """
-    def __init__(self, grid_height, grid_width):
+    def __init__(self, grid_height, grid_width, packed = False):
+        """
+        Create a game of the given size.  A 4x4 game can be packed into
+        a single integer of 4-bit tile exponents for fast moves.
+        """
+        if packed:
+            assert grid_height == 4 and grid_width == 4, "packed boards must be 4x4"
+            _build_row_tables()
         self._grid_height = grid_height
         self._grid_width = grid_width
+        self._packed = packed
+        self._bitboard = 0
         self._board = [0][0]
         self.reset() 
         self._initial_indices = {
@@ -63,13 +232,39 @@ class TwentyFortyEight:
         Reset the game so the grid is empty.
         """
         self._board = [[0 for dummy_width in xrange(self._grid_width)] for dummy_height in xrange(self._grid_height)]
+        self._bitboard = 0
+        # Empty squares as a list plus each square's index in it, so a
+        # square can be added, removed or picked at random in O(1)
+        self._empty_cells = [(row, col) for row in range(self._grid_height) for col in range(self._grid_width)]
+        self._empty_index = dict([(cell, index) for index, cell in enumerate(self._empty_cells)])
+        # Number of tiles of each value, used to find the max tile
+        self._tile_counts = {}
         
     def __str__(self):
         """
         Return a string representation of the grid for debugging.
         """
+        if self._packed:
+            return str([[self.get_tile(row, col) for col in range(4)] for row in range(4)])
         return str(self._board)
 
+    def get_max_tile(self):
+        """
+        Return the value of the largest tile on the board
+        """
+        if self._packed:
+            return max([self.get_tile(row, col) for row in range(4) for col in range(4)])
+        if not self._tile_counts:
+            return 0
+        return max(self._tile_counts.keys())
+
+    def get_packed(self):
+        """
+        Return the packed board as an integer, tile (row, col) is
+        stored as a log2 exponent in bits 4 * (4 * row + col)
+        """
+        return self._bitboard
+
     def get_grid_height(self):
         """
         Get the height of the board.
@@ -87,35 +282,36 @@ class TwentyFortyEight:
         Determines whether the player can move
         Returns a boolean
         """
-        is_full = True
-        top_bottom = False
-        left_right = False
-        for row in range(len(self._board) - 1):
-            for col in range(len(self._board[0]) - 1):
-                if self._board[row][col] == self._board[row][col + 1] or self._board[row + 1][col] == self._board[row + 1][col + 1]:
-                    left_right = True
-                if self._board[row][col] == self._board[row + 1][col] or self._board[row][col + 1] == self._board[row + 1][col + 1]:
-                    top_bottom = True
-        
-        for row in range(len(self._board)):
-            for col in range(len(self._board[0])):
-                if self._board[row][col] == 0:
-                    is_full = False
-                    
-        if is_full == True and top_bottom == False and left_right == False:
-            return False
-        else:
+        if self._packed:
+            board = self._bitboard
+            for index in range(16):
+                if (board >> (4 * index)) & 0xF == 0:
+                    return True
+            return move_packed(board, LEFT) != board or move_packed(board, UP) != board
+
+        if self._empty_cells:
             return True
+        # The board is full, so only a merge between neighbors can move
+        for row in range(self._grid_height):
+            for col in range(self._grid_width):
+                value = self._board[row][col]
+                if col + 1 < self._grid_width and value == self._board[row][col + 1]:
+                    return True
+                if row + 1 < self._grid_height and value == self._board[row + 1][col]:
+                    return True
+        return False
     
     def move(self, direction):
         """
         Move all tiles in the given direction and add
         a new tile if any tiles moved.
         """
-        for dummy_row in range(self._grid_height):
-            for dummy_col in range(self._grid_width):
-                if self._board[dummy_row][dummy_col] == 2048:
-                    print "Congratulations! You win!"
+        if self._packed:
+            self._move_packed(direction)
+            return
+
+        if self.get_max_tile() >= 2048:
+            print "Congratulations! You win!"
 
         has_changed = False
         
@@ -135,13 +331,29 @@ class TwentyFortyEight:
             for index in range(len(dummy_list)):
                 if self._board[dummy_list[index][0]][dummy_list[index][1]] != temp_list[index]:
                     has_changed = True
-                self.set_tile(dummy_list[index][0], dummy_list[index][1], temp_list[index])
+                    self.set_tile(dummy_list[index][0], dummy_list[index][1], temp_list[index])
 
         if has_changed == True:
             self.new_tile()
             
         if self._can_move() == False:
             print "Board is full with no legal moves. GAME OVER"
+
+    def _move_packed(self, direction):
+        """
+        Packed board version of move
+        """
+        board = self._bitboard
+        if self.get_max_tile() >= 2048:
+            print "Congratulations! You win!"
+
+        new_board = move_packed(board, direction)
+        if new_board != board:
+            self._bitboard = new_board
+            self.new_tile()
+
+        if self._can_move() == False:
+            print "Board is full with no legal moves. GAME OVER"
                     
             
     def new_tile(self):
@@ -150,11 +362,14 @@ class TwentyFortyEight:
         square.  The tile should be 2 90% of the time and
         4 10% of the time.
         """
-        random_row = randint(0, self._grid_height - 1)
-        random_col = randint(0, self._grid_width - 1)
-        while self._board[random_row][random_col] != 0:
-            random_row = randint(0, self._grid_height - 1)
-            random_col = randint(0, self._grid_width - 1)
+        if self._packed:
+            empty_cells = [(row, col) for row in range(4) for col in range(4)
+                           if self.get_tile(row, col) == 0]
+        else:
+            empty_cells = self._empty_cells
+        if not empty_cells:
+            return
+        random_row, random_col = empty_cells[randint(0, len(empty_cells) - 1)]
             
         chance = randint(1, 10)
         if chance == 1:
@@ -165,15 +380,560 @@ class TwentyFortyEight:
     def set_tile(self, row, col, value):
         """
         Set the tile at position row, col to have the given value.
+        Packed boards only hold 0 and powers of two up to
+        PACKED_MAX_TILE.
         """        
+        if self._packed:
+            assert value == 0 or (value <= PACKED_MAX_TILE and value & (value - 1) == 0), (
+                "packed boards hold powers of two up to " + str(PACKED_MAX_TILE))
+            shift = 4 * (4 * row + col)
+            self._bitboard = (self._bitboard & ~(0xF << shift)) | (_log2(value) << shift)
+            return
+        old_value = self._board[row][col]
+        if old_value == value:
+            return
         self._board[row][col] = value
+        if old_value == 0:
+            self._remove_empty((row, col))
+        else:
+            self._tile_counts[old_value] -= 1
+            if self._tile_counts[old_value] == 0:
+                del self._tile_counts[old_value]
+        if value == 0:
+            self._empty_index[(row, col)] = len(self._empty_cells)
+            self._empty_cells.append((row, col))
+        else:
+            self._tile_counts[value] = self._tile_counts.get(value, 0) + 1
+
+    def _remove_empty(self, cell):
+        """
+        Remove cell from the empty cell list by swapping in the last one
+        """
+        index = self._empty_index.pop(cell)
+        last_cell = self._empty_cells.pop()
+        if last_cell != cell:
+            self._empty_cells[index] = last_cell
+            self._empty_index[last_cell] = index
 
     def get_tile(self, row, col):
         """
         Return the value of the tile at position row, col.
+        On packed boards this is at most PACKED_MAX_TILE.
         """        
+        if self._packed:
+            exponent = int((self._bitboard >> (4 * (4 * row + col))) & 0xF)
+            if exponent:
+                return 1 << exponent
+            return 0
         return self._board[row][col]
  
-    
+
+class ExpectimaxPlayer:
+    """
+    Expectimax search player for 4x4 games.  Searches packed boards
+    and keeps a bounded LRU transposition table between moves.
+    """
+
+    def __init__(self, max_depth = 3, time_limit = None,
+                 cache_size = 200000, prob_threshold = 0.0001):
+        """
+        max_depth: number of player moves to look ahead
+        time_limit: seconds allowed per move, or None for no limit
+        cache_size: maximum number of chance nodes kept in the cache
+        prob_threshold: chance nodes less likely than this are scored
+        with the heuristic instead of being expanded
+        """
+        _build_row_tables()
+        _build_heuristic_table()
+        self._max_depth = max_depth
+        self._time_limit = time_limit
+        self._cache_size = cache_size
+        self._prob_threshold = prob_threshold
+        self._cache = collections.OrderedDict()
+        self._deadline = None
+        self._timed_out = False
+
+    def best_move(self, game):
+        """
+        Return the best direction to move for the given game, or None
+        if no move changes the board.  Searches one level deeper at a
+        time until max_depth or the time limit is reached.
+        """
+        assert game.get_grid_height() == 4 and game.get_grid_width() == 4, "expectimax needs a 4x4 game"
+        board = 0
+        for row in range(4):
+            for col in range(4):
+                board |= _log2(game.get_tile(row, col)) << (4 * (4 * row + col))
+
+        if self._time_limit != None:
+            self._deadline = time.time() + self._time_limit
+        else:
+            self._deadline = None
+        self._timed_out = False
+
+        best_direction = None
+        for depth in range(1, self._max_depth + 1):
+            direction = self._search_root(board, depth)
+            if self._timed_out:
+                break
+            best_direction = direction
+        if best_direction == None:
+            # Time ran out before depth 1 finished, fall back to any legal move
+            for direction in (UP, DOWN, LEFT, RIGHT):
+                if move_packed(board, direction) != board:
+                    return direction
+        return best_direction
+
+    def _search_root(self, board, depth):
+        """
+        Return the direction with the highest expected value at depth
+        """
+        best_direction = None
+        best_value = float("-inf")
+        for direction in (UP, DOWN, LEFT, RIGHT):
+            new_board = move_packed(board, direction)
+            if new_board != board:
+                value = self._chance_value(new_board, depth, 1.0)
+                if value > best_value:
+                    best_value = value
+                    best_direction = direction
+        return best_direction
+
+    def _heuristic(self, board):
+        """
+        Evaluate a packed board using rows and columns of ROW_HEURISTIC
+        """
+        transposed = _transpose(board)
+        total = 0.0
+        for shift in (0, 16, 32, 48):
+            total += ROW_HEURISTIC[(board >> shift) & 0xFFFF]
+            total += ROW_HEURISTIC[(transposed >> shift) & 0xFFFF]
+        return total
+
+    def _max_value(self, board, depth, prob):
+        """
+        Value of the best move from board, 0 if no move is possible
+        """
+        best_value = 0.0
+        for direction in (UP, DOWN, LEFT, RIGHT):
+            new_board = move_packed(board, direction)
+            if new_board != board:
+                best_value = max(best_value, self._chance_value(new_board, depth, prob))
+        return best_value
+
+    def _chance_value(self, board, depth, prob):
+        """
+        Expected value over all tile spawns on board, searching depth
+        more player moves.  prob is the chance of reaching this node.
+        """
+        if depth <= 1 or prob < self._prob_threshold:
+            return self._heuristic(board)
+        if self._deadline != None and time.time() > self._deadline:
+            self._timed_out = True
+            return self._heuristic(board)
+
+        cached = self._cache.pop(board, None)
+        if cached != None and cached[0] >= depth:
+            self._cache[board] = cached
+            return cached[1]
+
+        empty_shifts = [4 * index for index in range(16) if (board >> (4 * index)) & 0xF == 0]
+        total = 0.0
+        for shift in empty_shifts:
+            for exponent, spawn_prob in SPAWN_PROBS:
+                child_prob = prob * spawn_prob / len(empty_shifts)
+                total += spawn_prob * self._max_value(board | (exponent << shift), depth - 1, child_prob)
+        value = total / len(empty_shifts)
+
+        if not self._timed_out:
+            self._cache[board] = (depth, value)
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(False)
+        return value
+
+def _lines_view(grids, direction):
+    """
+    Return a view of an (N, H, W) array of grids whose last axis runs
+    along the lines of a move in direction, so every move slides tiles
+    towards index 0.  Writing to the view writes to grids.
+    """
+    if direction == LEFT:
+        return grids
+    elif direction == RIGHT:
+        return grids[:, :, ::-1]
+    elif direction == UP:
+        return grids.transpose(0, 2, 1)
+    else:
+        return grids.transpose(0, 2, 1)[:, :, ::-1]
+
+def _merge_lines(lines):
+    """
+    NumPy version of merge for a 2D array of lines of tile exponents.
+    Returns the merged lines and the points scored on each line.
+    """
+    # Slide the tiles to the front, keeping their order
+    order = numpy.argsort(lines == 0, axis = 1, kind = "stable")
+    tiles = numpy.take_along_axis(lines, order, axis = 1)
+    # Within a run of equal tiles, pairs merge from the front, so a
+    # tile merges with the next one when it sits an even number of
+    # places into its run
+    columns = numpy.arange(tiles.shape[1])
+    run_starts = numpy.ones(tiles.shape, dtype = bool)
+    run_starts[:, 1:] = tiles[:, 1:] != tiles[:, :-1]
+    run_start = numpy.maximum.accumulate(numpy.where(run_starts, columns, 0), axis = 1)
+    merges = numpy.zeros(tiles.shape, dtype = bool)
+    merges[:, :-1] = ((tiles[:, :-1] != 0) & (tiles[:, :-1] == tiles[:, 1:]) &
+                      ((columns[:-1] - run_start[:, :-1]) % 2 == 0))
+    scores = numpy.where(merges, numpy.left_shift(1, tiles + 1), 0).sum(axis = 1)
+    merged = tiles + merges
+    merged[:, 1:][merges[:, :-1]] = 0
+    order = numpy.argsort(merged == 0, axis = 1, kind = "stable")
+    return numpy.take_along_axis(merged, order, axis = 1), scores
+
+class BatchSimulator:
+    """
+    Plays many games side by side.  With NumPy the games are held in
+    an (N, H, W) array of tile exponents and every step is a handful
+    of array operations; without it, 4x4 games are packed boards moved
+    with table lookups.
+    """
+
+    def __init__(self, num_games, seed = None, grid_height = 4, grid_width = 4):
+        """
+        Create num_games games, seeded for reproducible runs.  Boards
+        other than 4x4 need NumPy.
+        """
+        self._num_games = num_games
+        self._grid_height = grid_height
+        self._grid_width = grid_width
+        if numpy != None:
+            self._rng = numpy.random.RandomState(seed)
+        else:
+            assert grid_height == 4 and grid_width == 4, "boards other than 4x4 need NumPy"
+            _build_row_tables()
+            _build_score_table()
+            self._rng = Random(seed)
+        self._boards = []
+        self._scores = []
+        self._alive = []
+        self.reset()
+
+    def reset(self):
+        """
+        Start every game again with two random tiles
+        """
+        if numpy != None:
+            self._boards = numpy.zeros((self._num_games, self._grid_height, self._grid_width),
+                                       dtype = numpy.int64)
+            self._scores = numpy.zeros(self._num_games, dtype = numpy.int64)
+            self._alive = numpy.ones(self._num_games, dtype = bool)
+        else:
+            self._boards = [0] * self._num_games
+            self._scores = [0] * self._num_games
+            self._alive = [True] * self._num_games
+        self.spawn_tiles()
+        self.spawn_tiles()
+
+    def get_boards(self):
+        """
+        Return the boards as a list of grids of tile values, one list
+        of rows per game
+        """
+        if numpy != None:
+            return numpy.where(self._boards > 0, numpy.left_shift(1, self._boards), 0).tolist()
+        boards = []
+        for board in self._boards:
+            grid = []
+            for row in range(4):
+                exponents = [(board >> (4 * (4 * row + col))) & 0xF for col in range(4)]
+                grid.append([1 << int(exponent) if exponent else 0 for exponent in exponents])
+            boards.append(grid)
+        return boards
+
+    def get_scores(self):
+        """
+        Return the list of per-game scores
+        """
+        if numpy != None:
+            return self._scores.tolist()
+        return list(self._scores)
+
+    def get_max_tiles(self):
+        """
+        Return the list of per-game largest tile values
+        """
+        if numpy != None:
+            exponents = self._boards.reshape(self._num_games, -1).max(axis = 1)
+            return numpy.where(exponents > 0, numpy.left_shift(1, exponents), 0).tolist()
+        max_tiles = []
+        for board in self._boards:
+            exponent = max([(board >> shift) & 0xF for shift in range(0, 64, 4)])
+            if exponent:
+                max_tiles.append(1 << int(exponent))
+            else:
+                max_tiles.append(0)
+        return max_tiles
+
+    def num_alive(self):
+        """
+        Return the number of games that still have a legal move
+        """
+        if numpy != None:
+            return int(self._alive.sum())
+        return self._alive.count(True)
+
+    def spawn_tiles(self, games = None):
+        """
+        Add a 2 (90%) or a 4 (10%) to a random empty square of each
+        listed game, or of every game if games is None.  One uniform
+        draw per game picks both the square and the tile.
+        """
+        if games == None:
+            games = range(self._num_games)
+        if numpy != None:
+            self._spawn_tiles_numpy(numpy.asarray(games, dtype = numpy.int64))
+            return
+        rolls = [self._rng.random() for dummy_game in games]
+        for game, roll in zip(games, rolls):
+            board = self._boards[game]
+            empty_shifts = [shift for shift in range(0, 64, 4) if (board >> shift) & 0xF == 0]
+            if empty_shifts:
+                position = roll * len(empty_shifts)
+                shift = empty_shifts[int(position)]
+                if position - int(position) < SPAWN_PROBS[0][1]:
+                    exponent = SPAWN_PROBS[0][0]
+                else:
+                    exponent = SPAWN_PROBS[1][0]
+                self._boards[game] = board | (exponent << shift)
+
+    def _spawn_tiles_numpy(self, games):
+        """
+        NumPy version of spawn_tiles, with a single draw for all games
+        """
+        rolls = self._rng.random_sample(len(games))
+        cells = self._boards.reshape(self._num_games, -1)
+        empty = cells[games] == 0
+        counts = empty.sum(axis = 1)
+        positions = rolls * counts
+        picks = positions.astype(numpy.int64)
+        squares = (empty.cumsum(axis = 1) > picks[:, None]).argmax(axis = 1)
+        exponents = numpy.where(positions - picks < SPAWN_PROBS[0][1],
+                                SPAWN_PROBS[0][0], SPAWN_PROBS[1][0])
+        has_room = counts > 0
+        cells[games[has_room], squares[has_room]] = exponents[has_room]
+
+    def move(self, directions):
+        """
+        Apply directions[game] to every live game, score merges and
+        spawn a tile on each board that changed.  A direction of None
+        leaves its game alone.  Games with no legal move afterwards
+        are marked as finished.
+        """
+        if numpy != None:
+            self._move_numpy(directions)
+            return
+        changed = []
+        for game in range(self._num_games):
+            direction = directions[game]
+            if not self._alive[game] or direction == None:
+                continue
+            board = self._boards[game]
+            new_board = move_packed(board, direction)
+            if new_board != board:
+                if direction == UP or direction == DOWN:
+                    rows = _transpose(board)
+                else:
+                    rows = board
+                self._scores[game] += (ROW_SCORE[rows & 0xFFFF] + ROW_SCORE[(rows >> 16) & 0xFFFF] +
+                                       ROW_SCORE[(rows >> 32) & 0xFFFF] + ROW_SCORE[(rows >> 48) & 0xFFFF])
+                self._boards[game] = new_board
+                changed.append(game)
+        self.spawn_tiles(changed)
+        for game in changed:
+            board = self._boards[game]
+            if move_packed(board, LEFT) == board and move_packed(board, UP) == board:
+                self._alive[game] = False
+
+    def _move_numpy(self, directions):
+        """
+        NumPy version of move, moving all games that share a direction
+        at once
+        """
+        directions = numpy.array([direction or 0 for direction in directions])
+        changed = numpy.zeros(self._num_games, dtype = bool)
+        for direction in (UP, DOWN, LEFT, RIGHT):
+            games = numpy.nonzero(self._alive & (directions == direction))[0]
+            if not len(games):
+                continue
+            boards = self._boards[games]
+            lines = _lines_view(boards, direction)
+            merged, scores = _merge_lines(lines.reshape(-1, lines.shape[2]))
+            moved = numpy.empty_like(boards)
+            _lines_view(moved, direction)[...] = merged.reshape(lines.shape)
+            self._boards[games] = moved
+            self._scores[games] += scores.reshape(len(games), -1).sum(axis = 1)
+            changed[games[(moved != boards).reshape(len(games), -1).any(axis = 1)]] = True
+
+        games = numpy.nonzero(changed)[0]
+        if not len(games):
+            return
+        self._spawn_tiles_numpy(games)
+        boards = self._boards[games]
+        self._alive[games] = ((boards == 0).reshape(len(games), -1).any(axis = 1) |
+                              (boards[:, :, 1:] == boards[:, :, :-1]).reshape(len(games), -1).any(axis = 1) |
+                              (boards[:, 1:, :] == boards[:, :-1, :]).reshape(len(games), -1).any(axis = 1))
+
+    def random_directions(self):
+        """
+        Strategy that picks a random legal direction for every game,
+        or None for games with no legal move
+        """
+        if numpy != None:
+            return self._random_directions_numpy()
+        directions = []
+        for board in self._boards:
+            legal = [direction for direction in (UP, DOWN, LEFT, RIGHT)
+                     if move_packed(board, direction) != board]
+            if legal:
+                directions.append(self._rng.choice(legal))
+            else:
+                directions.append(None)
+        return directions
+
+    def _random_directions_numpy(self):
+        """
+        NumPy version of random_directions, with a single draw for
+        all games
+        """
+        all_directions = (UP, DOWN, LEFT, RIGHT)
+        legal = numpy.zeros((self._num_games, len(all_directions)), dtype = bool)
+        for column, direction in enumerate(all_directions):
+            # A move is legal if some tile can slide into a gap or
+            # merge with the tile ahead of it
+            lines = _lines_view(self._boards, direction)
+            ahead = lines[:, :, :-1]
+            behind = lines[:, :, 1:]
+            movable = ((ahead == 0) & (behind != 0)) | ((ahead != 0) & (ahead == behind))
+            legal[:, column] = movable.reshape(self._num_games, -1).any(axis = 1)
+        counts = legal.sum(axis = 1)
+        picks = (self._rng.random_sample(self._num_games) * counts).astype(numpy.int64)
+        columns = (legal.cumsum(axis = 1) > picks[:, None]).argmax(axis = 1)
+        return [all_directions[column] if count else None
+                for column, count in zip(columns.tolist(), counts.tolist())]
+
+    def run(self, strategy = None, max_moves = None):
+        """
+        Play every game until it ends or max_moves moves have been made.
+        strategy takes the boards from get_boards and returns a list of
+        directions; the default plays random legal moves.
+
+        Returns a tuple of the per-game scores and max tiles
+        """
+        moves = 0
+        while self.num_alive() > 0 and (max_moves == None or moves < max_moves):
+            if strategy == None:
+                directions = self.random_directions()
+            else:
+                directions = strategy(self.get_boards())
+            self.move(directions)
+            moves += 1
+        return self.get_scores(), self.get_max_tiles()
+
+def _random_tiles(length):
+    """
+    Return a list of length random tiles, a quarter of them empty
+    """
+    return [randint(0, 3) and 2 ** randint(1, 4) for dummy_idx in range(length)]
+
+def _bench_merge(length, total_tiles):
+    """
+    Time merging random lines of the given length until total_tiles
+    tiles have been merged.  Returns the tiles merged per second.
+    """
+    lines = [_random_tiles(length) for dummy_line in range(max(1, total_tiles // length))]
+    start = time.time()
+    for line in lines:
+        merge(line)
+    return len(lines) * length / max(time.time() - start, 1e-9)
+
+def _bench_move(length, total_tiles):
+    """
+    Time one left or right move on each of a set of random 4 x length
+    boards holding total_tiles tiles between them.  Returns the tiles
+    moved per second.
+    """
+    games = []
+    for dummy_game in range(max(1, total_tiles // (4 * length))):
+        game = TwentyFortyEight(4, length)
+        for row in range(4):
+            game_row = _random_tiles(length)
+            for col in range(length):
+                game.set_tile(row, col, game_row[col])
+        games.append((game, randint(LEFT, RIGHT)))
+    start = time.time()
+    for game, direction in games:
+        game.move(direction)
+    return len(games) * 4 * length / max(time.time() - start, 1e-9)
+
+def _read_bench_baseline(filename):
+    """
+    Return the throughputs recorded in filename, keyed on (name,
+    length), or None if the file cannot be read
+    """
+    try:
+        baseline_file = open(filename)
+    except IOError:
+        return None
+    baseline = {}
+    try:
+        for line in baseline_file:
+            fields = line.split()
+            if len(fields) == 3:
+                baseline[(fields[0], int(fields[1]))] = float(fields[2])
+    finally:
+        baseline_file.close()
+    return baseline
+
+def benchmark(total_tiles = 100000, record = False, filename = BENCH_BASELINE_FILE):
+    """
+    Time merge and move over BENCH_LENGTHS and print tiles per second.
+    Inputs are built before the clock starts.
+
+    The throughputs are written to filename when record is True or
+    the file does not exist yet, in which case nothing is compared
+    and the run only checks scaling.  The file is specific to the
+    machine it was recorded on and is not checked in.  Otherwise the
+    run fails if any throughput falls below BENCH_TOLERANCE of the
+    recorded one.  It also fails if the time per tile on the longest
+    line is more than BENCH_SCALING_LIMIT times that of the shortest,
+    which would mean merge is no longer linear.
+    """
+    results = {}
+    for name, function in [("merge", _bench_merge), ("move", _bench_move)]:
+        for length in BENCH_LENGTHS:
+            rate = max([function(length, total_tiles) for dummy_run in range(BENCH_RUNS)])
+            results[(name, length)] = rate
+            print name, "length", length, ":", int(rate), "tiles/sec"
+        scaling = results[(name, BENCH_LENGTHS[0])] / results[(name, BENCH_LENGTHS[-1])]
+        assert scaling <= BENCH_SCALING_LIMIT, name + " throughput regressed: " + str(scaling) + "x slower per tile"
+
+    baseline = _read_bench_baseline(filename)
+    if record or baseline == None:
+        baseline_file = open(filename, "w")
+        try:
+            for key in sorted(results.keys()):
+                baseline_file.write(key[0] + " " + str(key[1]) + " " + repr(results[key]) + "\n")
+        finally:
+            baseline_file.close()
+        if baseline == None:
+            print "No baseline found in", filename + ", so nothing was compared"
+        print "Recorded baseline in", filename
+        return
+    for key in sorted(results.keys()):
+        if key in baseline:
+            ratio = results[key] / baseline[key]
+            assert ratio >= BENCH_TOLERANCE, (key[0] + " length " + str(key[1]) +
+                                              " throughput regressed to " + str(ratio) + " of baseline")
+
 poc_2048_gui.run_gui(TwentyFortyEight(4, 4))
 
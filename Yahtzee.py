@@ -7,6 +7,46 @@ Simplifications:  only allow discard and roll, only score against upper level
 import codeskulptor
 codeskulptor.set_timeout(20)
 
+import math
+
+# Policy files are memory-mapped where the modules are available
+try:
+    import mmap
+    import struct
+except ImportError:
+    mmap = None
+    struct = None
+
+# Batch scoring uses NumPy where it is available
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Memo of expected values keyed on (sorted held dice, sides, free dice)
+# and of weighted rolls keyed on (sides, free dice).  Each memo is
+# cleared when it grows past MEMO_SIZE entries.
+MEMO_SIZE = 100000
+EXPECTED_VALUE_MEMO = {}
+ROLL_MEMO = {}
+
+# Rolls of more than this many distinct outcomes are streamed by
+# expected_value instead of being kept in ROLL_MEMO
+ROLL_MEMO_LIMIT = 100000
+
+# score_hands works through this many hands at a time with NumPy, so
+# its temporary arrays stay a few megabytes however many hands it gets
+SCORE_CHUNK = 65536
+
+# A turn has this many rolls, with a hold chosen before each reroll
+NUM_ROLLS = 3
+
+# Policy file layout: a header, then one entry per (roll, hand) with
+# the hold as a bitmask over the sorted hand and its expected value
+POLICY_MAGIC = "YPOL"
+POLICY_HEADER = "<4sHHH"
+POLICY_ENTRY = "<Hf"
+
 def gen_all_sequences(outcomes, length):
     """
     Iterative function that enumerates the set of all sequences of
@@ -25,6 +65,60 @@ def gen_all_sequences(outcomes, length):
     return answer_set
 
 
+def iter_all_sequences(outcomes, length):
+    """
+    Generator that yields every sequence of outcomes of given length,
+    in lexicographic order of the positions in outcomes.  Only the
+    current sequence is kept in memory.
+    """
+    outcomes = list(outcomes)
+    if length > 0 and not outcomes:
+        return
+    indices = [0] * length
+    while True:
+        yield tuple([outcomes[index] for index in indices])
+        # Advance the rightmost position that is not at its last outcome
+        position = length - 1
+        while position >= 0 and indices[position] == len(outcomes) - 1:
+            indices[position] = 0
+            position -= 1
+        if position < 0:
+            return
+        indices[position] += 1
+
+
+def iter_weighted_rolls(num_die_sides, num_free_dice):
+    """
+    Generator that yields each distinct roll of num_free_dice dice as
+    a sorted tuple in lexicographic order, paired with the number of
+    ordered sequences that sort to it.  Only the current roll is kept
+    in memory.
+    """
+    if num_free_dice > 0 and num_die_sides < 1:
+        return
+    roll = [1] * num_free_dice
+    while True:
+        weight = math.factorial(num_free_dice)
+        run = 1
+        for index in range(1, num_free_dice + 1):
+            if index < num_free_dice and roll[index] == roll[index - 1]:
+                run += 1
+            else:
+                weight //= math.factorial(run)
+                run = 1
+        yield (tuple(roll), weight)
+        # Advance the rightmost die below the top face and level the
+        # dice after it up to it, which keeps the roll sorted
+        position = num_free_dice - 1
+        while position >= 0 and roll[position] == num_die_sides:
+            position -= 1
+        if position < 0:
+            return
+        roll[position] += 1
+        for index in range(position + 1, num_free_dice):
+            roll[index] = roll[position]
+
+
 def score(hand):
     """
     Compute the maximal score for a Yahtzee hand according to the
@@ -34,14 +128,59 @@ def score(hand):
 
     Returns an integer score 
     """
-    score_table = []
+    totals = {}
     for die in hand:
-        value = hand.count(die) * die
-        score_table.append(value)
-    if not score_table:
+        totals[die] = totals.get(die, 0) + die
+    if not totals:
         return 0
     else:
-        return max(score_table)
+        return max(totals.values())
+
+
+def score_hands(hands, num_die_sides):
+    """
+    Score many hands of the same size at once.
+
+    hands: sequence or (N, dice) array of hands
+    num_die_sides: number of sides on each die
+
+    Returns a list of scores, or an array of scores if NumPy is
+    available
+    """
+    if numpy == None:
+        return [score(hand) for hand in hands]
+    hands = numpy.asarray(hands)
+    num_hands = hands.shape[0]
+    scores = numpy.zeros(num_hands, dtype = numpy.int64)
+    if num_hands == 0 or hands.shape[1] == 0:
+        return scores
+    die_values = numpy.arange(1, num_die_sides + 1)
+    for begin in range(0, num_hands, SCORE_CHUNK):
+        chunk = hands[begin:begin + SCORE_CHUNK].astype(numpy.int64)
+        size = chunk.shape[0]
+        # One histogram row per hand, built with a single bincount
+        offsets = (chunk - 1) + numpy.arange(size)[:, None] * num_die_sides
+        counts = numpy.bincount(offsets.ravel(), minlength = size * num_die_sides)
+        counts = counts.reshape(size, num_die_sides)
+        scores[begin:begin + size] = (counts * die_values).max(axis = 1)
+    return scores
+
+
+def gen_weighted_rolls(num_die_sides, num_free_dice):
+    """
+    Enumerate the distinct rolls of num_free_dice dice as sorted
+    tuples, each paired with the number of ordered sequences that
+    sort to it (its multinomial weight).
+    """
+    key = (num_die_sides, num_free_dice)
+    if key in ROLL_MEMO:
+        return ROLL_MEMO[key]
+
+    weighted_rolls = list(iter_weighted_rolls(num_die_sides, num_free_dice))
+    if len(ROLL_MEMO) >= MEMO_SIZE:
+        ROLL_MEMO.clear()
+    ROLL_MEMO[key] = weighted_rolls
+    return weighted_rolls
 
 
 def expected_value(held_dice, num_die_sides, num_free_dice):
@@ -55,20 +194,26 @@ def expected_value(held_dice, num_die_sides, num_free_dice):
 
     Returns a floating point expected value
     """
-    outcomes = []
-    for side in range(num_die_sides):
-        val = side + 1
-        outcomes.append(val)
-    all_seq = gen_all_sequences(outcomes, num_free_dice)
-    total_score = 0.0
-    for seq in all_seq:
-        possible_hand = list(held_dice)
-        for die in seq:
-            possible_hand.append(die)
-        value = score(tuple(possible_hand))
-        total_score += value
-    
-    return total_score / len(all_seq)
+    held_dice = tuple(sorted(held_dice))
+    key = (held_dice, num_die_sides, num_free_dice)
+    if key in EXPECTED_VALUE_MEMO:
+        return EXPECTED_VALUE_MEMO[key]
+
+    # Scores are integers, so summing them exactly and dividing once
+    # gives the same result as averaging every ordered sequence
+    if multichoose(num_die_sides, num_free_dice) <= ROLL_MEMO_LIMIT:
+        weighted_rolls = gen_weighted_rolls(num_die_sides, num_free_dice)
+    else:
+        weighted_rolls = iter_weighted_rolls(num_die_sides, num_free_dice)
+    total_score = 0
+    for roll, weight in weighted_rolls:
+        total_score += weight * score(held_dice + roll)
+    value = float(total_score) / num_die_sides ** num_free_dice
+
+    if len(EXPECTED_VALUE_MEMO) >= MEMO_SIZE:
+        EXPECTED_VALUE_MEMO.clear()
+    EXPECTED_VALUE_MEMO[key] = value
+    return value
 
 
 def gen_all_holds(hand):
@@ -81,7 +226,7 @@ def gen_all_holds(hand):
     """
     keeper_set = set([()])
     outcomes = [0, 1]
-    masks = list(gen_all_sequences(outcomes, len(hand)))
+    masks = iter_all_sequences(outcomes, len(hand))
         
     for outcome in masks:
         hold = []
@@ -94,6 +239,48 @@ def gen_all_holds(hand):
     #print keeper_set
     return keeper_set
 
+def evaluate_holds(hand, num_die_sides):
+    """
+    Compute the expected value of every hold of hand.  With NumPy all
+    holds that leave the same number of free dice are scored against
+    all rolls of those dice in one pass.
+
+    hand: full yahtzee hand
+    num_die_sides: number of sides on each die
+
+    Returns a dictionary mapping each hold from gen_all_holds to its
+    expected value
+    """
+    holds = list(gen_all_holds(hand))
+    if numpy == None:
+        return dict([(hold, expected_value(hold, num_die_sides, len(hand) - len(hold)))
+                     for hold in holds])
+
+    faces = numpy.arange(1, num_die_sides + 1)
+    values = {}
+    for num_free_dice in range(len(hand) + 1):
+        group = [hold for hold in holds if len(hand) - len(hold) == num_free_dice]
+        if not group:
+            continue
+        held_counts = numpy.zeros((len(group), num_die_sides), dtype = numpy.int64)
+        for index in range(len(group)):
+            for die in group[index]:
+                held_counts[index, die - 1] += 1
+        weighted_rolls = gen_weighted_rolls(num_die_sides, num_free_dice)
+        roll_counts = numpy.zeros((len(weighted_rolls), num_die_sides), dtype = numpy.int64)
+        weights = numpy.zeros(len(weighted_rolls), dtype = numpy.int64)
+        for index in range(len(weighted_rolls)):
+            roll, weights[index] = weighted_rolls[index]
+            for die in roll:
+                roll_counts[index, die - 1] += 1
+        # (holds, rolls, faces) counts, scored by the best face
+        scores = ((held_counts[:, None, :] + roll_counts[None, :, :]) * faces).max(axis = 2)
+        totals = scores.dot(weights)
+        for index in range(len(group)):
+            values[group[index]] = float(totals[index]) / num_die_sides ** num_free_dice
+    return values
+
+
 def strategy(hand, num_die_sides):
     """
     Compute the hold that maximizes the expected value when the
@@ -116,6 +303,171 @@ def strategy(hand, num_die_sides):
     return (best_value, best_hold)
 
 
+def multichoose(num_values, size):
+    """
+    Number of sorted hands of the given size with num_values faces
+    """
+    if size == 0:
+        return 1
+    if num_values <= 0:
+        return 0
+    return math.factorial(num_values + size - 1) // (math.factorial(size) * math.factorial(num_values - 1))
+
+
+def hand_rank(hand, num_die_sides):
+    """
+    Position of a sorted hand in the lexicographic order of all sorted
+    hands of its size, computed without building the list
+    """
+    rank = 0
+    lowest = 1
+    for index in range(len(hand)):
+        remaining = len(hand) - index - 1
+        for die in range(lowest, hand[index]):
+            rank += multichoose(num_die_sides - die + 1, remaining)
+        lowest = hand[index]
+    return rank
+
+
+class PolicyTable:
+    """
+    Best hold and expected turn score for every sorted hand before each
+    reroll.  Entries live in a list after solving or in a memory-mapped
+    file after loading, and each lookup reads one entry.
+    """
+
+    def __init__(self, num_dice, num_die_sides, entries = None, policy_buffer = None):
+        """
+        entries: list of (hold mask, value) pairs, or
+        policy_buffer: policy file contents in the POLICY_ENTRY format
+        """
+        self._num_dice = num_dice
+        self._num_die_sides = num_die_sides
+        self._num_hands = multichoose(num_die_sides, num_dice)
+        self._entries = entries
+        self._buffer = policy_buffer
+
+    def get_num_dice(self):
+        """
+        Return the number of dice in a hand
+        """
+        return self._num_dice
+
+    def get_num_die_sides(self):
+        """
+        Return the number of sides on each die
+        """
+        return self._num_die_sides
+
+    def _entry(self, index):
+        """
+        Return the (hold mask, value) pair stored at index
+        """
+        if self._entries != None:
+            return self._entries[index]
+        offset = struct.calcsize(POLICY_HEADER) + index * struct.calcsize(POLICY_ENTRY)
+        return struct.unpack_from(POLICY_ENTRY, self._buffer, offset)
+
+    def lookup(self, roll_number, hand):
+        """
+        roll_number: rolls made so far this turn, 1 to NUM_ROLLS - 1
+        hand: full yahtzee hand
+
+        Returns a tuple of the expected score of the rest of the turn
+        and the tuple of dice to hold
+        """
+        assert 1 <= roll_number < NUM_ROLLS, "roll_number must be from 1 to NUM_ROLLS - 1"
+        assert len(hand) == self._num_dice, "hand must have " + str(self._num_dice) + " dice"
+        hand = tuple(sorted(hand))
+        assert 1 <= hand[0] and hand[-1] <= self._num_die_sides, "dice must be from 1 to " + str(self._num_die_sides)
+        index = (roll_number - 1) * self._num_hands + hand_rank(hand, self._num_die_sides)
+        mask, value = self._entry(index)
+        hold = tuple([hand[idx] for idx in range(len(hand)) if mask & (1 << idx)])
+        return (value, hold)
+
+    def save(self, filename):
+        """
+        Write the table to filename in the compact binary format
+        """
+        num_entries = (NUM_ROLLS - 1) * self._num_hands
+        policy_file = open(filename, "wb")
+        try:
+            policy_file.write(struct.pack(POLICY_HEADER, POLICY_MAGIC, NUM_ROLLS,
+                                          self._num_dice, self._num_die_sides))
+            for index in range(num_entries):
+                policy_file.write(struct.pack(POLICY_ENTRY, *self._entry(index)))
+        finally:
+            policy_file.close()
+
+
+def load_policy(filename):
+    """
+    Memory-map a policy file written by PolicyTable.save
+
+    Returns a PolicyTable that reads entries straight from the file
+    """
+    policy_file = open(filename, "rb")
+    try:
+        policy_buffer = mmap.mmap(policy_file.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        policy_file.close()
+    header_size = struct.calcsize(POLICY_HEADER)
+    assert len(policy_buffer) >= header_size, "not a policy file for this planner"
+    magic, num_rolls, num_dice, num_die_sides = struct.unpack_from(POLICY_HEADER, policy_buffer, 0)
+    assert magic == POLICY_MAGIC and num_rolls == NUM_ROLLS, "not a policy file for this planner"
+    num_entries = (NUM_ROLLS - 1) * multichoose(num_die_sides, num_dice)
+    expected_size = header_size + num_entries * struct.calcsize(POLICY_ENTRY)
+    assert len(policy_buffer) == expected_size, "policy file " + filename + " has the wrong size"
+    return PolicyTable(num_dice, num_die_sides, policy_buffer = policy_buffer)
+
+
+def solve_turn(num_dice, num_die_sides):
+    """
+    Compute the best hold for every hand before every reroll of a
+    NUM_ROLLS roll turn by backward induction.  The last roll is
+    scored with score, and each earlier hand is worth the best
+    expected value over its holds.
+
+    Returns a PolicyTable
+    """
+    hands = [roll for roll, dummy_weight in gen_weighted_rolls(num_die_sides, num_dice)]
+    next_values = [score(hand) for hand in hands]
+    # Tables are built from the last reroll backwards
+    tables = []
+    for dummy_roll in range(NUM_ROLLS - 1):
+        # Hold values depend only on the held dice, so share them
+        hold_values = {}
+        table = []
+        for hand in hands:
+            best_value = -1.0
+            best_hold = ()
+            for hold in gen_all_holds(hand):
+                if hold not in hold_values:
+                    total = 0.0
+                    for roll, weight in gen_weighted_rolls(num_die_sides, num_dice - len(hold)):
+                        new_hand = tuple(sorted(hold + roll))
+                        total += weight * next_values[hand_rank(new_hand, num_die_sides)]
+                    hold_values[hold] = total / num_die_sides ** (num_dice - len(hold))
+                if hold_values[hold] > best_value:
+                    best_value = hold_values[hold]
+                    best_hold = hold
+            mask = 0
+            position = 0
+            for die in best_hold:
+                while hand[position] != die:
+                    position += 1
+                mask |= 1 << position
+                position += 1
+            table.append((mask, best_value))
+        tables.insert(0, table)
+        next_values = [value for dummy_mask, value in table]
+
+    entries = []
+    for table in tables:
+        entries.extend(table)
+    return PolicyTable(num_dice, num_die_sides, entries)
+
+
 def run_example():
     """
     Compute the dice to hold and expected score for an example hand
@@ -3,9 +3,20 @@ Zombie Apocalypse Simulator mini-project
 """
 
 import random
+import time
 import poc_grid
-import poc_queue
-import poc_zombie_gui
+
+# Batched movement uses NumPy where it is available
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Headless scenarios run in a process pool where one is available
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 # global constants
 EMPTY = 0 
@@ -16,6 +27,22 @@ OBSTACLE = "obstacle"
 HUMAN = "human"
 ZOMBIE = "zombie"
 
+# Incremental distance fields are recomputed from scratch when more
+# than INCREMENTAL_MAX_REPAIR of the grid would need repairing
+INCREMENTAL_MAX_REPAIR = 0.25
+
+# Agents are moved with NumPy only when there are at least
+# NUMPY_MIN_AGENTS of them and at least NUMPY_MIN_AGENT_DENSITY per
+# cell, since its path converts the whole distance field to an array
+NUMPY_MIN_AGENTS = 500
+NUMPY_MIN_AGENT_DENSITY = 0.02
+
+# Characters used in headless scenario layouts, any other character
+# is an empty cell
+LAYOUT_OBSTACLE = "#"
+LAYOUT_ZOMBIE = "Z"
+LAYOUT_HUMAN = "H"
+
 
 class Zombie(poc_grid.Grid):
     """
@@ -29,6 +56,10 @@ class Zombie(poc_grid.Grid):
         Create a simulation of given size with given obstacles,
         humans, and zombies
         """
+        self._incremental = False
+        self._field_cache = {}
+        self._topology_version = 0
+        self._reset_topology(grid_height, grid_width)
         poc_grid.Grid.__init__(self, grid_height, grid_width)
         if obstacle_list != None:
             for cell in obstacle_list:
@@ -48,8 +79,66 @@ class Zombie(poc_grid.Grid):
         Reset zombie and human lists to be empty
         """
         poc_grid.Grid.clear(self)
+        self._reset_topology(self.get_grid_height(), self.get_grid_width())
         self._zombie_list = []
         self._human_list = []
+
+    def _reset_topology(self, grid_height, grid_width):
+        """
+        Build the flat copy of the obstacle grid used by
+        compute_distance_field.  Cell (row, col) is at index
+        (row + 1) * (grid_width + 2) + col + 1, so the grid has a
+        blocked border and neighbors never need bounds checks.
+        """
+        stride = grid_width + 2
+        size = (grid_height + 2) * stride
+        self._stride = stride
+        self._passable = [False] * size
+        for row in range(grid_height):
+            start = (row + 1) * stride + 1
+            self._passable[start:start + grid_width] = [True] * grid_width
+        self._four_offsets = (-stride, stride, -1, 1)
+        # Neighbor steps as (flat offset, row step, col step), in the
+        # same order as poc_grid's four_neighbors and eight_neighbors
+        self._four_steps = ((-stride, -1, 0), (stride, 1, 0), (-1, 0, -1), (1, 0, 1))
+        self._eight_steps = self._four_steps + ((-stride - 1, -1, -1), (-stride + 1, -1, 1),
+                                                (stride - 1, 1, -1), (stride + 1, 1, 1))
+        # Distance buffer reused between calls and its starting values
+        self._distance_scratch = [0] * size
+        self._distance_blank = [grid_height * grid_width] * size
+        self._topology_version += 1
+        self._adjacency = None
+        self._passable_array = None
+
+    def set_full(self, row, col):
+        """
+        Set cell to be an obstacle
+        """
+        poc_grid.Grid.set_full(self, row, col)
+        self._passable[(row + 1) * self._stride + col + 1] = False
+        self._topology_version += 1
+        self._adjacency = None
+        self._passable_array = None
+
+    def set_empty(self, row, col):
+        """
+        Set cell to be free of obstacles
+        """
+        poc_grid.Grid.set_empty(self, row, col)
+        self._passable[(row + 1) * self._stride + col + 1] = True
+        self._topology_version += 1
+        self._adjacency = None
+        self._passable_array = None
+
+    def set_incremental(self, incremental):
+        """
+        Turn incremental distance fields on or off.  When on, each
+        entity type keeps its distance field between calls and only
+        repairs the cells affected by moved entities.  The returned
+        rows are then shared and updated in place by later calls.
+        """
+        self._incremental = incremental
+        self._field_cache = {}
         
     def add_zombie(self, row, col):
         """
@@ -96,82 +185,461 @@ class Zombie(poc_grid.Grid):
         Distance at member of entity_queue is zero
         Shortest paths avoid obstacles and use distance_type distances
         """
-        visited = poc_grid.Grid(poc_grid.Grid.get_grid_height(self), poc_grid.Grid.get_grid_width(self))
-        distance_field = [[poc_grid.Grid.get_grid_height(self) * poc_grid.Grid.get_grid_width(self) for dummy_col in range(poc_grid.Grid.get_grid_width(self))]
-                       for dummy_row in range(poc_grid.Grid.get_grid_height(self))]
-        boundary = poc_queue.Queue()
+        height = self.get_grid_height()
+        width = self.get_grid_width()
+        stride = self._stride
         if entity_type == ZOMBIE:
-            for zombie in self._zombie_list:
-                boundary.enqueue(zombie)
+            sources = self._zombie_list
         else:
-            for human in self._human_list:
-                boundary.enqueue(human)
-        for cell in boundary:
-            visited.set_full(cell[0], cell[1])
-            distance_field[cell[0]][cell[1]] = 0
-        
-        while boundary:
-            current_cell = boundary.dequeue()
-            distance = distance_field[current_cell[0]][current_cell[1]] + 1
-            neighbors = self.four_neighbors(current_cell[0], current_cell[1])
-            for neighbor in neighbors:
-                if visited.is_empty(neighbor[0], neighbor[1]):
-                    visited.set_full(neighbor[0], neighbor[1])
-                    if self.is_empty(neighbor[0], neighbor[1]):
-                        distance_field[neighbor[0]][neighbor[1]] = distance
-                        boundary.enqueue(neighbor)
-                        
-        return distance_field
-  
-    def move_humans(self, zombie_distance):
+            sources = self._human_list
+
+        if not self._incremental:
+            distance = self._distance_scratch
+            self._fill_distance(sources, distance)
+            return [distance[(row + 1) * stride + 1:(row + 1) * stride + 1 + width]
+                    for row in range(height)]
+
+        counts = {}
+        for cell in sources:
+            index = (cell[0] + 1) * stride + cell[1] + 1
+            counts[index] = counts.get(index, 0) + 1
+        cache = self._field_cache.get(entity_type)
+        if cache != None and cache["version"] == self._topology_version:
+            changed = self._repair_distance(cache["distance"], cache["counts"], counts)
+            if changed != None:
+                rows = cache["rows"]
+                for index in changed:
+                    rows[index // stride - 1][index % stride - 1] = cache["distance"][index]
+                cache["counts"] = counts
+                return rows
+
+        # Recompute in full, into the cached lists if there are any
+        if cache == None:
+            cache = {"distance": [0] * len(self._distance_blank), "rows": None}
+            self._field_cache[entity_type] = cache
+        distance = cache["distance"]
+        self._fill_distance(sources, distance)
+        if cache["rows"] == None:
+            cache["rows"] = [distance[(row + 1) * stride + 1:(row + 1) * stride + 1 + width]
+                             for row in range(height)]
+        else:
+            for row in range(height):
+                cache["rows"][row][:] = distance[(row + 1) * stride + 1:(row + 1) * stride + 1 + width]
+        cache["counts"] = counts
+        cache["version"] = self._topology_version
+        return cache["rows"]
+
+    def _neighbor_table(self):
+        """
+        Return the four way passable neighbors of every cell in
+        compressed sparse row form, as a pair (start, adjacency) where
+        the neighbors of flat index i are adjacency[start[i]:start[i + 1]].
+        The table is rebuilt only after the obstacles change.
+        """
+        if self._adjacency == None:
+            passable = self._passable
+            offsets = self._four_offsets
+            stride = self._stride
+            size = len(passable)
+            start = [0] * (size + 1)
+            adjacency = []
+            for index in range(stride, size - stride):
+                if 0 < index % stride < stride - 1:
+                    for offset in offsets:
+                        if passable[index + offset]:
+                            adjacency.append(index + offset)
+                start[index + 1] = len(adjacency)
+            for index in range(size - stride, size):
+                start[index + 1] = len(adjacency)
+            self._adjacency = (start, adjacency)
+        return self._adjacency
+
+    def _fill_distance(self, sources, distance):
+        """
+        Fill the flat distance list by breadth first search from the
+        source cells
+        """
+        stride = self._stride
+        # A cell is unvisited while it still holds the starting distance
+        unvisited = self.get_grid_height() * self.get_grid_width()
+        distance[:] = self._distance_blank
+        start, adjacency = self._neighbor_table()
+        boundary = []
+        for cell in sources:
+            index = (cell[0] + 1) * stride + cell[1] + 1
+            if distance[index] != 0:
+                distance[index] = 0
+                boundary.append(index)
+
+        head = 0
+        while head < len(boundary):
+            current = boundary[head]
+            head += 1
+            next_distance = distance[current] + 1
+            for neighbor in adjacency[start[current]:start[current + 1]]:
+                if distance[neighbor] == unvisited:
+                    distance[neighbor] = next_distance
+                    boundary.append(neighbor)
+
+    def _repair_distance(self, distance, old_counts, new_counts):
+        """
+        Update a flat distance list for a new set of source cells,
+        given as dictionaries from flat index to number of entities.
+
+        Cells that lose every shortest path to a source are reset and
+        refilled from their neighbors, then new sources spread out
+        until they stop improving distances.
+
+        Returns the flat indices whose distance may have changed, or
+        None if the repair would change more than INCREMENTAL_MAX_REPAIR
+        of the grid.  The distance list is left partly repaired in that
+        case.
+        """
+        removed = [index for index in old_counts if index not in new_counts]
+        added = [index for index in new_counts if index not in old_counts]
+        # Each moved source takes about its share of the grid with it,
+        # so give up early when that alone is over the limit
+        if max(len(removed), len(added)) > INCREMENTAL_MAX_REPAIR * max(len(old_counts), len(new_counts)):
+            return None
+
+        unvisited = self.get_grid_height() * self.get_grid_width()
+        passable = self._passable
+        offsets = self._four_offsets
+        start, adjacency = self._neighbor_table()
+        max_repair = int(INCREMENTAL_MAX_REPAIR * unvisited)
+
+        # Find the cells whose distance relied on a removed source.
+        # Candidates are checked a whole distance layer after their
+        # parents, so a cell is invalid once none of its neighbors one
+        # step closer is still valid.
+        invalid = set(removed)
+        queue = []
+        for index in invalid:
+            for neighbor in adjacency[start[index]:start[index + 1]]:
+                if distance[neighbor] == 1:
+                    queue.append(neighbor)
+        head = 0
+        while head < len(queue):
+            current = queue[head]
+            head += 1
+            if current in invalid or current in new_counts:
+                continue
+            parent_distance = distance[current] - 1
+            supported = False
+            for offset in offsets:
+                neighbor = current + offset
+                if distance[neighbor] == parent_distance and neighbor not in invalid:
+                    supported = True
+                    break
+            if supported:
+                continue
+            invalid.add(current)
+            if len(invalid) > max_repair:
+                return None
+            for neighbor in adjacency[start[current]:start[current + 1]]:
+                if distance[neighbor] == parent_distance + 2:
+                    queue.append(neighbor)
+
+        # Refill the invalid cells from their valid neighbors, closest
+        # first, using one bucket per distance
+        for index in invalid:
+            distance[index] = unvisited
+        buckets = {}
+        for index in invalid:
+            if not passable[index]:
+                continue
+            best = unvisited
+            for offset in offsets:
+                neighbor_distance = distance[index + offset]
+                if neighbor_distance < unvisited and neighbor_distance + 1 < best:
+                    best = neighbor_distance + 1
+            if best < unvisited:
+                distance[index] = best
+                buckets.setdefault(best, []).append(index)
+        changed = list(invalid)
+        level = 0
+        while buckets:
+            if level not in buckets:
+                level += 1
+                continue
+            for current in buckets.pop(level):
+                if distance[current] != level:
+                    continue
+                for neighbor in adjacency[start[current]:start[current + 1]]:
+                    if distance[neighbor] > level + 1:
+                        distance[neighbor] = level + 1
+                        buckets.setdefault(level + 1, []).append(neighbor)
+                        changed.append(neighbor)
+                        if len(changed) > max_repair:
+                            return None
+            level += 1
+
+        # Spread the new sources while they shorten distances
+        queue = []
+        for index in added:
+            if distance[index] != 0:
+                distance[index] = 0
+                queue.append(index)
+                changed.append(index)
+        head = 0
+        while head < len(queue):
+            current = queue[head]
+            head += 1
+            next_distance = distance[current] + 1
+            for neighbor in adjacency[start[current]:start[current + 1]]:
+                if distance[neighbor] > next_distance:
+                    distance[neighbor] = next_distance
+                    queue.append(neighbor)
+                    changed.append(neighbor)
+                    if len(changed) > max_repair:
+                        return None
+        return changed
+
+    def catch_humans(self):
+        """
+        Remove every human sharing a cell with a zombie and return the
+        number removed
+        """
+        zombie_cells = set(self._zombie_list)
+        survivors = [human for human in self._human_list if human not in zombie_cells]
+        caught = len(self._human_list) - len(survivors)
+        self._human_list = survivors
+        return caught
+
+    def move_humans(self, zombie_distance, rng = random):
         """
         Function that moves humans away from zombies, diagonal moves
-        are allowed
+        are allowed.  Ties are broken with rng.
         """
-        temp_human_list = []
-        for human in self._human_list:
-            neighbors = self.eight_neighbors(human[0], human[1])
-            max_distance = 0
-            temp_neighbors = []
-            temp_neighbors.append(human)
-            for neighbor in neighbors:
-                distance = zombie_distance[neighbor[0]][neighbor[1]]
-                self_dist = zombie_distance[human[0]][human[1]]
-                if distance > max_distance and distance > self_dist and self.is_empty(neighbor[0], neighbor[1]):
-                    max_distance = distance
-                    temp_neighbors = []
-                if zombie_distance[neighbor[0]][neighbor[1]] == max_distance and self.is_empty(neighbor[0], neighbor[1]):
-                    temp_neighbors.append(neighbor)
-            choice = random.choice(temp_neighbors)
-            temp_human_list.append(choice)
-        self._human_list = temp_human_list
-            
-    
-    def move_zombies(self, human_distance):
+        self._human_list = self._move_batch(self._human_list, zombie_distance,
+                                            self._eight_steps, 1, rng)
+
+    def move_zombies(self, human_distance, rng = random):
         """
         Function that moves zombies towards humans, no diagonal moves
-        are allowed
+        are allowed.  Ties are broken with rng.
         """
-        temp_zombie_list = []
-        for zombie in self._zombie_list:
-            neighbors = self.four_neighbors(zombie[0], zombie[1])
-            min_distance = self.get_grid_width() * self.get_grid_height()
-            temp_neighbors = []
-            temp_neighbors.append(zombie)
-            for neighbor in neighbors:
-                distance = human_distance[neighbor[0]][neighbor[1]]
-                self_dist = human_distance[zombie[0]][zombie[1]]
-                if distance < min_distance and distance < self_dist and self.is_empty(neighbor[0], neighbor[1]):
-                    min_distance = distance
-                    temp_neighbors = []
-                if human_distance[neighbor[0]][neighbor[1]] == min_distance and self.is_empty(neighbor[0], neighbor[1]):
-                    temp_neighbors.append(neighbor)
-            choice = random.choice(temp_neighbors)
-            temp_zombie_list.append(choice)
-        self._zombie_list = temp_zombie_list
+        self._zombie_list = self._move_batch(self._zombie_list, human_distance,
+                                             self._four_steps, -1, rng)
+
+    def _move_batch(self, agents, distance_field, steps, sign, rng):
+        """
+        Move all agents one step at once.  Each agent scores cells by
+        sign times distance and may move to an empty neighbor scoring
+        above both itself and the score of an unreached cell (0 for
+        humans, minus the grid area for zombies).  Given such moves it
+        picks among the empty neighbors with the best score, otherwise
+        between staying and any empty neighbor with the unreached
+        score.  One number is drawn from rng per agent, in order, and
+        used as random.choice uses it, so results do not depend on
+        whether NumPy is used.
+
+        Returns the new list of agent positions
+        """
+        if not agents:
+            return []
+        area = self.get_grid_height() * self.get_grid_width()
+        if sign > 0:
+            floor = 0
+        else:
+            floor = -area
+        draws = [rng.random() for dummy_agent in agents]
+        if (numpy != None and len(agents) >= NUMPY_MIN_AGENTS and
+                len(agents) >= NUMPY_MIN_AGENT_DENSITY * area):
+            return self._move_batch_numpy(agents, distance_field, steps,
+                                          sign, floor, draws)
+
+        stride = self._stride
+        passable = self._passable
+        moved = []
+        for agent, draw in zip(agents, draws):
+            row, col = agent
+            index = (row + 1) * stride + col + 1
+            threshold = max(floor, sign * distance_field[row][col])
+            best = None
+            choices = [agent]
+            for offset, row_step, col_step in steps:
+                if not passable[index + offset]:
+                    continue
+                score = sign * distance_field[row + row_step][col + col_step]
+                if score > threshold and (best == None or score > best):
+                    best = score
+                    choices = []
+                if score == best or (best == None and score == floor):
+                    choices.append((row + row_step, col + col_step))
+            moved.append(choices[int(draw * len(choices))])
+        return moved
+
+    def _move_batch_numpy(self, agents, distance_field, steps, sign, floor, draws):
+        """
+        NumPy version of _move_batch that scores every agent's
+        neighborhood with array operations
+        """
+        if self._passable_array is None:
+            self._passable_array = numpy.array(self._passable, dtype = bool)
+        field = numpy.asarray(distance_field, dtype = numpy.int64)
+        positions = numpy.array(agents, dtype = numpy.int64).reshape(-1, 2)
+        rows = positions[:, 0]
+        cols = positions[:, 1]
+        index = (rows + 1) * self._stride + cols + 1
+        offsets = numpy.array([step[0] for step in steps], dtype = numpy.int64)
+        neighbor_rows = rows[:, None] + numpy.array([step[1] for step in steps], dtype = numpy.int64)
+        neighbor_cols = cols[:, None] + numpy.array([step[2] for step in steps], dtype = numpy.int64)
+        empty = self._passable_array[index[:, None] + offsets]
+        # Neighbors off the grid are never empty, so clipping them onto
+        # the grid only reads a value that is then ignored
+        neighbor_scores = sign * field[numpy.clip(neighbor_rows, 0, field.shape[0] - 1),
+                                       numpy.clip(neighbor_cols, 0, field.shape[1] - 1)]
+
+        threshold = numpy.maximum(sign * field[rows, cols], floor)
+        better = empty & (neighbor_scores > threshold[:, None])
+        has_better = better.any(axis = 1)
+        best = numpy.where(better, neighbor_scores, floor).max(axis = 1)
+        # Agents with a better move choose among the best neighbors,
+        # the rest choose between staying (choice -1) and the
+        # neighbors with the unreached score
+        target = numpy.where(has_better, best, floor)
+        choices = empty & (neighbor_scores == target[:, None])
+        stay = (~has_better).astype(numpy.int64)
+        picks = (numpy.array(draws) * (choices.sum(axis = 1) + stay)).astype(numpy.int64) - stay
+        column = (choices.cumsum(axis = 1) > picks[:, None]).argmax(axis = 1)
+        agent_index = numpy.arange(len(agents))
+        moved_rows = numpy.where(picks < 0, rows, neighbor_rows[agent_index, column])
+        moved_cols = numpy.where(picks < 0, cols, neighbor_cols[agent_index, column])
+        return list(zip(moved_rows.tolist(), moved_cols.tolist()))
+
+def parse_layout(text):
+    """
+    Read a scenario layout drawn as lines of text, one line per row,
+    using the LAYOUT characters.  Blank lines are skipped and short
+    rows are padded with empty cells.
+
+    Returns a tuple (grid_height, grid_width, obstacle_list,
+    zombie_list, human_list)
+    """
+    rows = [line.rstrip() for line in text.splitlines() if line.strip()]
+    width = max([len(row) for row in rows] + [0])
+    obstacle_list = []
+    zombie_list = []
+    human_list = []
+    for row in range(len(rows)):
+        for col in range(len(rows[row])):
+            char = rows[row][col]
+            if char == LAYOUT_OBSTACLE:
+                obstacle_list.append((row, col))
+            elif char == LAYOUT_ZOMBIE:
+                zombie_list.append((row, col))
+            elif char == LAYOUT_HUMAN:
+                human_list.append((row, col))
+    return (len(rows), width, obstacle_list, zombie_list, human_list)
+
+def load_layout(filename):
+    """
+    Read a scenario layout from a text file, as parse_layout
+    """
+    layout_file = open(filename)
+    try:
+        return parse_layout(layout_file.read())
+    finally:
+        layout_file.close()
+
+def run_scenario(layout, turns, seed):
+    """
+    Simulate a layout from parse_layout for a number of turns without
+    the GUI.  Each turn the humans flee, the zombies stalk and any
+    human a zombie reaches is caught.  Ties are broken by a
+    random.Random seeded with seed.
+
+    Returns a dictionary with the keys humans, survivors,
+    survival_rate, mean_survival_turns (turns lived by each human,
+    counting survivors as living every turn), first_catch (the turn
+    of the first catch, or None) and wall_time
+    """
+    start = time.time()
+    grid_height, grid_width, obstacle_list, zombie_list, human_list = layout
+    rng = random.Random(seed)
+    zombie = Zombie(grid_height, grid_width, obstacle_list, zombie_list, human_list)
+    humans = zombie.num_humans()
+    survival_turns = 0
+    first_catch = None
+    turn = 0
+    caught = zombie.catch_humans()
+    while True:
+        if caught:
+            if first_catch == None:
+                first_catch = turn
+            survival_turns += caught * turn
+        if turn == turns or not zombie.num_humans():
+            break
+        turn += 1
+        zombie.move_humans(zombie.compute_distance_field(ZOMBIE), rng)
+        zombie.move_zombies(zombie.compute_distance_field(HUMAN), rng)
+        caught = zombie.catch_humans()
+    survivors = zombie.num_humans()
+    survival_turns += survivors * turns
+    if humans:
+        survival_rate = float(survivors) / humans
+        mean_survival_turns = float(survival_turns) / humans
+    else:
+        survival_rate = 1.0
+        mean_survival_turns = float(turns)
+    return {"humans": humans,
+            "survivors": survivors,
+            "survival_rate": survival_rate,
+            "mean_survival_turns": mean_survival_turns,
+            "first_catch": first_catch,
+            "wall_time": time.time() - start}
+
+def _run_scenario_cell(cell):
+    """
+    Run one simulation for run_scenarios and return its table row
+    """
+    name, layout, turns, seed = cell
+    row = run_scenario(layout, turns, seed)
+    row["scenario"] = name
+    row["turns"] = turns
+    row["seed"] = seed
+    return row
+
+def run_scenarios(scenarios, turns, seeds, processes = None):
+    """
+    Simulate every scenario once per seed without the GUI.
+
+    scenarios: list of (name, layout) pairs, layouts as returned by
+        parse_layout or load_layout
+    turns: number of turns to simulate
+    seeds: list of seeds for breaking ties
+    processes: number of worker processes, None for one per core
+
+    Returns a list of dictionaries, one per run, with the keys of
+    run_scenario plus scenario, turns and seed.  Runs happen serially
+    if no process pool is available.
+    """
+    cells = []
+    for name, layout in scenarios:
+        for seed in seeds:
+            cells.append((name, layout, turns, seed))
+
+    if multiprocessing == None or processes == 1:
+        return [_run_scenario_cell(cell) for cell in cells]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_run_scenario_cell, cells)
+    finally:
+        pool.close()
+        pool.join()
+    return results
 
 # Start up gui for simulation - You will need to write some code above
-# before this will work without errors
+# before this will work without errors.  The GUI is only imported and
+# started when this file is run directly, so run_scenarios works
+# where poc_zombie_gui is not available.
+
+# Uncomment to compare layout files in bulk
+# for row in run_scenarios([("Map", load_layout("map.txt"))], 100, range(20)):
+#     print row
 
-poc_zombie_gui.run_gui(Zombie(30, 40))
+if __name__ == "__main__":
+    import poc_zombie_gui
+    poc_zombie_gui.run_gui(Zombie(30, 40))
 